@@ -8,6 +8,7 @@
 # TODO use exiftool instead of PIL to get yaw, pitch, roll and other metadata
 
 import sys
+import re
 import PIL.Image
 import PIL.ExifTags
 
@@ -62,6 +63,42 @@ def img_pos(name):
             ret.append(exif_data['DateTime'])
     return ret
 
+def img_camera(name):
+    """
+    get camera parameters from image
+    :param name: image path
+    :returns: dictionary of image width, height (pixels), focal length (mm)
+              and camera model, focal length and model only if available
+    """
+    with PIL.Image.open(name) as img:
+        ret = {'width': img.size[0], 'height': img.size[1]}
+        try:
+            exif = img._getexif()
+        except AttributeError:
+            exif = None
+    if exif is not None:
+        exif_data = {PIL.ExifTags.TAGS[k]: v for k, v in exif.items()
+                     if k in PIL.ExifTags.TAGS}
+        if 'FocalLength' in exif_data:
+            ret['focal'] = to_num(exif_data['FocalLength'])
+        if 'Model' in exif_data:
+            ret['model'] = exif_data['Model']
+    return ret
+
+def img_yaw(name):
+    """
+    get camera yaw from XMP metadata of the image (DJI drones)
+    :param name: image path
+    :returns: yaw angle in degrees clockwise from north or None
+    """
+    with open(name, 'rb') as f:
+        data = f.read(1 << 18)  # XMP packet is near to the beginning
+    for tag in (b'GimbalYawDegree', b'FlightYawDegree'):
+        match = re.search(tag + rb'(?:="|>)\s*([+-]?[0-9.]+)', data)
+        if match:
+            return float(match.group(1))
+    return None
+
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print("Usage: {} image_file(s)".format(sys.argv[0]))
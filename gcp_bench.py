@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+    Benchmarks for gcp_find.py, all gcp_find.py parameters can be used
+    - comparison of the fast (ArUco3) and the classic detection on images
+    - synthetic images with known marker positions to measure speed,
+      memory usage and recall
+    - start up time of gcp_find.py and the slowest imports
+"""
+import os
+import sys
+import copy
+import glob
+import time
+import math
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+import cv2
+from cv2 import aruco
+from gcp_find import GcpFind, cmd_params
+
+def_repeat = 1          # number of repeated detections
+def_tolerance = 2.0     # max center distance of the same marker in pixels
+def_mpix = 12.0         # size of synthetic images in megapixels
+def_nmarkers = 10       # number of markers on synthetic images
+def_msize = [40, 120]   # range of marker sizes on synthetic images
+def_angle = 180.0       # max rotation of markers
+def_blur = 1.5          # max sigma of gaussian blur
+def_burn = 2            # max burn in effect in pixels
+def_noise = 4.0         # sigma of gaussian noise
+def_grayrate = 0.5      # rate of black/gray markers
+def_value = 95          # gray color of black/gray markers
+def_quality = 90        # JPEG quality of synthetic images
+def_startup_limit = 0.5 # max start up time of gcp_find.py in seconds
+def_imports = 10        # number of slowest imports listed
+
+def run_mode(args, names, fast=None):
+    """ detect markers on images
+
+        :param args: processed command line parameters
+        :param names: list of image paths
+        :param fast: use fast ArUco3 detection, default from args
+        :return: list of (read time, gray time, detect time, ids, corners) tuples for images
+    """
+    args = copy.copy(args)
+    if fast is not None:
+        args.fast = fast
+    args.no_cache = True
+    args.names = names
+    detector = GcpFind(args, aruco.DetectorParameters()).detector
+    results = []
+    for name in names:
+        t1 = time.perf_counter()
+        frame = detector.read_image(name)
+        t2 = time.perf_counter()
+        if frame is None:
+            print(f'Cannot read image {name}', file=sys.stderr)
+            results.append((t2 - t1, 0.0, 0.0, np.zeros(0, np.int32),
+                            np.zeros((0, 4, 2), np.float32)))
+            continue
+        gray = detector.gray_image(frame)
+        t3 = time.perf_counter()
+        del frame
+        times = []
+        for _ in range(args.repeat):
+            t4 = time.perf_counter()
+            ids, corners, _ = detector.detect(gray, name)
+            times.append(time.perf_counter() - t4)
+        results.append((t2 - t1, t3 - t2, min(times), ids, corners))
+    return results
+
+def match(ids, corners, ref_ids, ref_centers, tolerance):
+    """ match markers to reference markers by id and center
+
+        :param ids: marker ids
+        :param corners: marker corners (n x 4 x 2)
+        :param ref_ids: reference marker ids
+        :param ref_centers: reference marker centers (m x 2)
+        :param tolerance: max distance of centers, single value or one for each reference marker
+        :return: number of matched markers and list of center distances
+    """
+    centers = corners.mean(axis=1)
+    tolerance = np.broadcast_to(tolerance, len(ref_ids))
+    used = np.zeros(len(ids), bool)
+    dists = []
+    for j, center, tol in zip(ref_ids, ref_centers, tolerance):
+        dist = np.linalg.norm(centers - center, axis=1)
+        dist[(ids != j) | used] = np.inf
+        if dist.size and dist.min() <= tol:
+            used[dist.argmin()] = True
+            dists.append(dist.min())
+    return len(dists), dists
+
+def report(names, classic, fast, tolerance):
+    """ print results of the comparison of fast and classic detection
+
+        :param names: list of image paths
+        :param classic: results of classic detection
+        :param fast: results of fast detection
+        :param tolerance: max distance of centers of the same marker
+    """
+    print(f'{"image":30s} {"read ms":>8s} {"classic ms":>10s} {"fast ms":>8s} '
+          f'{"speedup":>7s} {"markers":>7s} {"recall":>6s} {"extra":>5s}')
+    n_ref = n_found = n_extra = 0
+    t_classic = t_fast = 0.0
+    all_dists = []
+    for name, cla, fas in zip(names, classic, fast):
+        found, dists = match(fas[3], fas[4], cla[3], cla[4].mean(axis=1), tolerance)
+        extra = len(fas[3]) - found
+        recall = found / len(cla[3]) if len(cla[3]) else 1.0
+        speedup = cla[2] / fas[2] if fas[2] > 0 else 0.0
+        print(f'{name[-30:]:30s} {cla[0]*1000:8.1f} {cla[2]*1000:10.1f} '
+              f'{fas[2]*1000:8.1f} {speedup:7.2f} {len(cla[3]):7d} '
+              f'{recall:6.2f} {extra:5d}')
+        n_ref += len(cla[3])
+        n_found += found
+        n_extra += extra
+        t_classic += cla[2]
+        t_fast += fas[2]
+        all_dists += dists
+    recall = n_found / n_ref if n_ref else 1.0
+    speedup = t_classic / t_fast if t_fast > 0 else 0.0
+    print(f'{"total":30s} {"":8s} {t_classic*1000:10.1f} {t_fast*1000:8.1f} '
+          f'{speedup:7.2f} {n_ref:7d} {recall:6.2f} {n_extra:5d}')
+    if all_dists:
+        print(f'center difference mean {np.mean(all_dists):.3f} max {np.max(all_dists):.3f} pixels')
+
+def get_dict(dict_id):
+    """ get ArUco dictionary the same way as aruco_make.py
+
+        :param dict_id: dictionary id, 99 for the special 3x3 dictionary
+        :return: ArUco dictionary
+    """
+    if dict_id == 99:     # use special 3x3 dictionary
+        return aruco.extendDictionary(32, 3)
+    return aruco.getPredefinedDictionary(dict_id)
+
+def texture(height, width, rng):
+    """ generate aerial like background from noise of several scales
+
+        :param height: image height
+        :param width: image width
+        :param rng: random generator
+        :return: color image
+    """
+    img = np.zeros((height, width), np.float32)
+    weight = 1.0
+    cell = max(height, width) / 4
+    while cell >= 2:
+        small = rng.random((max(2, int(height / cell)), max(2, int(width / cell))),
+                           dtype=np.float32)
+        img += weight * cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+        weight *= 0.6
+        cell /= 4
+    img = cv2.normalize(img, None, 0, 1, cv2.NORM_MINMAX)
+    # vegetation and soil colors (BGR)
+    low = np.array([40, 80, 60], np.float32)
+    high = np.array([150, 190, 200], np.float32)
+    res = np.empty((height, width, 3), np.uint8)
+    for i in range(3):
+        res[:, :, i] = low[i] + img * (high[i] - low[i])
+    return res
+
+def render_marker(img, aruco_dict, marker_id, side, center, angle, gray, rng, args):
+    """ paste a marker with white border to the image
+
+        :param img: color image to paste marker on
+        :param aruco_dict: ArUco dictionary
+        :param marker_id: id of marker
+        :param side: side of marker in pixels
+        :param center: center of marker on image (x, y)
+        :param angle: rotation of marker in degrees
+        :param gray: use black/gray marker instead of black/white
+        :param rng: random generator
+        :param args: processed command line parameters
+    """
+    cells = aruco_dict.markerSize + 2
+    cell = max(4, int(math.ceil(side / cells)))
+    marker = aruco.generateImageMarker(aruco_dict, marker_id, cell * cells)
+    pad = cell
+    patch = np.full((marker.shape[0] + 2 * pad, marker.shape[1] + 2 * pad), 255, np.uint8)
+    patch[pad:-pad, pad:-pad] = marker
+    if gray:
+        patch[patch == 255] = args.value
+    burn = rng.integers(0, args.burn + 1) if args.burn > 0 else 0
+    if burn:
+        # overexposed white parts eat into black ones
+        patch = cv2.dilate(patch, np.ones((2 * burn + 1, 2 * burn + 1), np.uint8))
+        patch[:pad, :] = patch[-pad:, :] = patch[:, :pad] = patch[:, -pad:] = patch.max()
+    # affine transformation of marker center to the image
+    scale = side / marker.shape[0]
+    patch_center = (patch.shape[1] - 1) / 2
+    mat = cv2.getRotationMatrix2D((patch_center, patch_center), angle, scale)
+    half = int(math.ceil(patch.shape[0] * scale * 0.75)) + 2
+    x0 = int(center[0]) - half
+    y0 = int(center[1]) - half
+    mat[0, 2] += center[0] - patch_center - x0
+    mat[1, 2] += center[1] - patch_center - y0
+    roi = img[y0:y0+2*half, x0:x0+2*half]
+    warped = cv2.warpAffine(patch, mat, (roi.shape[1], roi.shape[0]),
+                            flags=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+    mask = cv2.warpAffine(np.full(patch.shape, 255, np.uint8), mat,
+                          (roi.shape[1], roi.shape[0])).astype(np.float32) / 255
+    roi[:] = (roi * (1 - mask[:, :, None]) + warped[:, :, None] * mask[:, :, None]).astype(np.uint8)
+    sigma = rng.uniform(0, args.blur) if args.blur > 0 else 0
+    if sigma > 0.3:
+        roi[:] = cv2.GaussianBlur(roi, (0, 0), sigma)
+
+def synthetic_image(args, aruco_dict, rng):
+    """ generate a synthetic image with markers
+
+        :param args: processed command line parameters
+        :param aruco_dict: ArUco dictionary
+        :param rng: random generator
+        :return: color image and list of (id, x, y, side) tuples of markers
+    """
+    width = int(math.sqrt(args.mpix * 1e6 * 4 / 3))
+    height = int(width * 3 / 4)
+    img = texture(height, width, rng)
+    # markers are placed in different cells of a grid to avoid overlap,
+    # pasted marker with white border is inside the cell
+    half = int(math.ceil(args.msize[1] * 1.5 * 0.75)) + 3
+    cell = max(int(args.msize[1] * 2.5), 2 * half + 1)
+    cols = width // cell
+    rows = height // cell
+    n = min(args.nmarkers, cols * rows)
+    n_ids = aruco_dict.bytesList.shape[0]
+    ids = rng.choice(n_ids, n, replace=n > n_ids)
+    truth = []
+    for k, pos in enumerate(rng.choice(cols * rows, n, replace=False)):
+        side = rng.uniform(args.msize[0], args.msize[1])
+        x = pos % cols * cell + rng.uniform(half, cell - half)
+        y = pos // cols * cell + rng.uniform(half, cell - half)
+        angle = rng.uniform(-args.angle, args.angle)
+        render_marker(img, aruco_dict, int(ids[k]), side, (x, y), angle,
+                      rng.random() < args.grayrate, rng, args)
+        truth.append((int(ids[k]), x, y, side))
+    if args.noise > 0:
+        # add noise in strips to limit memory usage
+        for i in range(0, height, 512):
+            strip = img[i:i+512]
+            noise = rng.normal(0, args.noise, strip.shape[:2]).astype(np.float32)
+            strip[:] = np.clip(strip + noise[:, :, None], 0, 255).astype(np.uint8)
+    return img, truth
+
+def make_images(args, path):
+    """ generate synthetic images and write them to files
+
+        :param args: processed command line parameters
+        :param path: directory to write images to
+        :return: list of image paths and list of markers for images
+    """
+    rng = np.random.default_rng(args.seed)
+    aruco_dict = get_dict(args.dict[0])     # markers of the first dictionary
+    names = []
+    truths = []
+    for i in range(args.synthetic):
+        img, truth = synthetic_image(args, aruco_dict, rng)
+        name = os.path.join(path, f'synthetic{i:04d}.jpg')
+        cv2.imwrite(name, img, [cv2.IMWRITE_JPEG_QUALITY, args.quality])
+        names.append(name)
+        truths.append(truth)
+    return names, truths
+
+def peak_rss():
+    """ get peak resident set size of this process
+
+        :return: peak RSS in MB or None if not available
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 1024 / 1024    # bytes on macOS
+    return rss / 1024
+
+def report_synthetic(names, truths, results, wall):
+    """ print results of detection on synthetic images
+
+        :param names: list of image paths
+        :param truths: list of markers for images
+        :param results: detection results for images
+        :param wall: total processing time
+    """
+    print(f'{"image":20s} {"read ms":>8s} {"gray ms":>8s} {"detect ms":>9s} '
+          f'{"markers":>7s} {"found":>5s} {"false":>5s} {"error px":>8s}')
+    n_ref = n_found = n_false = 0
+    all_dists = []
+    for name, truth, res in zip(names, truths, results):
+        ref_ids = np.array([t[0] for t in truth], np.int32)
+        ref_centers = np.array([t[1:3] for t in truth], np.float32).reshape(-1, 2)
+        # centers within the half marker are accepted, the error is reported
+        tols = [t[3] / 2 for t in truth]
+        found, dists = match(res[3], res[4], ref_ids, ref_centers, tols)
+        err = f'{np.mean(dists):8.3f}' if dists else f'{"-":>8s}'
+        print(f'{os.path.basename(name)[-20:]:20s} {res[0]*1000:8.1f} {res[1]*1000:8.1f} '
+              f'{res[2]*1000:9.1f} {len(truth):7d} {found:5d} {len(res[3]) - found:5d} {err}')
+        n_ref += len(truth)
+        n_found += found
+        n_false += len(res[3]) - found
+        all_dists += dists
+    n = len(results)
+    print(f'images/s: {n / wall:.3f}')
+    for i, stage in enumerate(('read', 'gray', 'detect')):
+        print(f'{stage} ms mean: {np.mean([r[i] for r in results])*1000:.1f}')
+    rss = peak_rss()
+    if rss is not None:
+        print(f'peak RSS: {rss:.1f} MB')
+    print(f'recall: {n_found / n_ref if n_ref else 1.0:.3f} ({n_found}/{n_ref})')
+    print(f'false positives: {n_false}')
+    if all_dists:
+        print(f'center error mean {np.mean(all_dists):.3f} '
+              f'p95 {np.percentile(all_dists, 95):.3f} max {np.max(all_dists):.3f} pixels')
+
+def synthetic(args):
+    """ run benchmark on synthetic images
+
+        :param args: processed command line parameters
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.keep if args.keep else tmp
+        os.makedirs(path, exist_ok=True)
+        # images are generated in a separate process, so peak RSS is
+        # not affected
+        gen_args = argparse.Namespace(**vars(args))
+        gen_args.output = None      # stdout cannot be passed to a process
+        with multiprocessing.Pool(1) as pool:
+            names, truths = pool.apply(make_images, (gen_args, path))
+        t1 = time.perf_counter()
+        results = run_mode(args, names)
+        wall = time.perf_counter() - t1
+        report_synthetic(names, truths, results, wall)
+
+def import_times(text):
+    """ parse output of python -X importtime
+
+        :param text: stderr of python -X importtime
+        :return: list of (cumulative time in ms, module name) of top level imports, slowest first
+    """
+    times = []
+    for line in text.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        items = line.split('|')
+        try:
+            cumulative = int(items[1])
+        except (IndexError, ValueError):
+            continue    # header line
+        # nested imports are indented
+        if not items[2].startswith('  '):
+            times.append((cumulative / 1000, items[2].strip()))
+    return sorted(times, reverse=True)
+
+def startup(args, names):
+    """ measure start up time of gcp_find.py for help and for a run on
+        a single image in new processes
+
+        :param args: processed command line parameters
+        :param names: list of image paths, the first is used
+        :return: True if all start up times are below the limit
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gcp_find.py')
+    runs = [('help', [script, '--help']),
+            ('one image', [script, '--no-cache', '-j', '1', names[0]])]
+    passed = True
+    print(f'{"command":12s} {"first s":>8s} {"min s":>8s} {"mean s":>8s}')
+    for title, cmd in runs:
+        times = []
+        for _ in range(max(1, args.repeat)):
+            t1 = time.perf_counter()
+            subprocess.run([sys.executable] + cmd, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL, check=False)
+            times.append(time.perf_counter() - t1)
+        print(f'{title:12s} {times[0]:8.3f} {min(times):8.3f} {sum(times) / len(times):8.3f}')
+        passed = passed and times[0] < args.startup_limit
+    # import times of a run on an image
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + runs[1][1],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          text=True, check=False)
+    print('slowest imports (cumulative ms)')
+    for cumulative, module in import_times(proc.stderr)[:def_imports]:
+        print(f'{module:24s} {cumulative:8.1f}')
+    print(f'start up limit {args.startup_limit} s: {"ok" if passed else "exceeded"}')
+    return passed
+
+def synthetic_params(parser):
+    """ add parameters of synthetic images to the command line parser
+
+        :param parser: command line parser object
+    """
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='number of synthetic images to generate and process, default 0')
+    parser.add_argument('--keep', type=str, default=None,
+                        help='directory to keep synthetic images in, default temporary directory')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed of random generator for synthetic images, default random')
+    parser.add_argument('--mpix', type=float, default=def_mpix,
+                        help=f'size of synthetic images in megapixels, default {def_mpix}')
+    parser.add_argument('--nmarkers', type=int, default=def_nmarkers,
+                        help=f'number of markers on synthetic images, default {def_nmarkers}')
+    parser.add_argument('--msize', type=float, nargs=2, default=def_msize,
+                        help=f'range of marker sizes in pixels on synthetic images, default {def_msize[0]} {def_msize[1]}')
+    parser.add_argument('--angle', type=float, default=def_angle,
+                        help=f'max rotation of markers in degrees, default {def_angle}')
+    parser.add_argument('--blur', type=float, default=def_blur,
+                        help=f'max sigma of gaussian blur of markers, default {def_blur}')
+    parser.add_argument('--burn', type=int, default=def_burn,
+                        help=f'max burn in effect in pixels, default {def_burn}')
+    parser.add_argument('--noise', type=float, default=def_noise,
+                        help=f'sigma of gaussian noise, default {def_noise}')
+    parser.add_argument('--grayrate', type=float, default=def_grayrate,
+                        help=f'rate of black/gray markers, default {def_grayrate}')
+    parser.add_argument('--value', type=int, default=def_value,
+                        help=f'shade of black/gray markers, default {def_value}')
+    parser.add_argument('--quality', type=int, default=def_quality,
+                        help=f'JPEG quality of synthetic images, default {def_quality}')
+
+if __name__ == "__main__":
+    params = aruco.DetectorParameters()
+    parser = argparse.ArgumentParser(description='compare fast and classic marker detection, markers found by classic detection are the reference, or detect markers on synthetic images')
+    cmd_params(parser, params)
+    parser.add_argument('--repeat', type=int, default=def_repeat,
+                        help=f'number of repeated detections, the fastest is used, default {def_repeat}')
+    parser.add_argument('--tolerance', type=float, default=def_tolerance,
+                        help=f'max center distance of the same marker in pixels, default {def_tolerance}')
+    parser.add_argument('--startup', action="store_true",
+                        help='measure start up time of gcp_find.py for help and a single image run in new processes, the first image is used, default image samples/burnt.png')
+    parser.add_argument('--startup_limit', type=float, default=def_startup_limit,
+                        help=f'max start up time in seconds, default {def_startup_limit}')
+    synthetic_params(parser)
+    args = parser.parse_args()
+    if args.synthetic > 0:
+        synthetic(args)
+        sys.exit(0)
+    if not args.names:
+        # bundled sample images
+        samples = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples')
+        if args.startup:
+            # small image, detection time should not be measured
+            args.names = [os.path.join(samples, 'burnt.png')]
+        else:
+            args.names = sorted(glob.glob(os.path.join(samples, '*.jpg')) +
+                                glob.glob(os.path.join(samples, '*.png')))
+    names = []
+    for name in args.names:
+        names += glob.glob(name)
+    if not names:
+        print('no images found', file=sys.stderr)
+        sys.exit(1)
+    if args.startup:
+        sys.exit(0 if startup(args, names) else 1)
+    res_classic = run_mode(args, names, False)
+    res_fast = run_mode(args, names, True)
+    report(names, res_classic, res_fast, args.tolerance)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+    Thin client of gcp_find.py server mode (--serve), images are sent to
+    the server and the output is printed in the same format as gcp_find.py,
+    the output parameters (type, input coordinates, limit, epsg) are taken
+    from the server, only standard modules are imported for fast start
+
+    for usage help:
+    gcp_client.py --help
+"""
+import sys
+import os
+import json
+import socket
+import base64
+import argparse
+
+def server_address(text):
+    """ parse server address, the same as in gcp_find.py
+
+        :param text: path to Unix domain socket or host:port
+        :return: tuple of socket family and address
+    """
+    host, sep, port = text.rpartition(':')
+    if sep and '/' not in text:
+        try:
+            return socket.AF_INET, (host if host else 'localhost', int(port))
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(f'invalid port: {text}') from e
+    if not hasattr(socket, 'AF_UNIX'):
+        raise argparse.ArgumentTypeError(f'Unix domain sockets are not supported: {text}')
+    return socket.AF_UNIX, text
+
+def image_request(image_name, send):
+    """ create request of an image
+
+        :param image_name: path to image
+        :param send: send image data instead of path
+        :return: request dictionary
+    """
+    if send:
+        with open(image_name, 'rb') as f:
+            data = base64.b64encode(f.read()).decode('ascii')
+        return {'name': os.path.basename(image_name), 'data': data}
+    # server may run in other working directory
+    return {'image': os.path.abspath(image_name)}
+
+def ask(sock, request):
+    """ send a request to the server and read the answer
+
+        :param sock: file object of connection
+        :param request: request dictionary
+        :return: answer dictionary
+    """
+    sock.write(json.dumps(request).encode('utf-8') + b'\n')
+    sock.flush()
+    line = sock.readline()
+    if not line:
+        raise ConnectionError('connection closed by server')
+    return json.loads(line)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='send images to a gcp_find.py server and print the output')
+    parser.add_argument('names', metavar='file_names', type=str, nargs='+',
+                        help='image files to process')
+    parser.add_argument('-s', '--server', type=server_address, required=True,
+                        help='address of server, path to Unix domain socket or host:port')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='name of output GCP list file, default stdout')
+    parser.add_argument('--send', action="store_true",
+                        help='send image data instead of path, if the server cannot read the images, default: False')
+    parser.add_argument('--raw', action="store_true",
+                        help='print marker ids and corners of images as JSON lines, default: False')
+    args = parser.parse_args()
+    family, address = args.server
+    try:
+        with socket.socket(family, socket.SOCK_STREAM) as conn:
+            conn.connect(address)
+            with conn.makefile('rwb') as stream:
+                if args.raw:
+                    answers = [ask(stream, image_request(name, args.send))
+                               for name in args.names]
+                    text = ''.join(json.dumps(answer) + '\n' for answer in answers)
+                else:
+                    answer = ask(stream, {'images': [image_request(name, args.send)
+                                                     for name in args.names]})
+                    if 'error' in answer:
+                        print(answer['error'], file=sys.stderr)
+                        sys.exit(1)
+                    for msg in answer['messages']:
+                        print(msg, file=sys.stderr)
+                    text = answer['output']
+    except OSError as e:
+        print(f'cannot use server {address}: {e}', file=sys.stderr)
+        sys.exit(1)
+    if args.output is None:
+        sys.stdout.write(text)
+    else:
+        try:
+            with open(args.output, 'w', encoding="ascii") as f:
+                f.write(text)
+        except OSError:
+            print('cannot open output file', file=sys.stderr)
+            sys.exit(1)
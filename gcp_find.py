@@ -14,40 +14,2026 @@
 import sys
 import os
 import time
+import math
 import glob
 import json
+import hashlib
+import sqlite3
+import socket
+import socketserver
+import stat
+import base64
+import io
+import struct
+import zlib
 import argparse
+import tempfile
+import multiprocessing
+import threading
+import heapq
+import collections
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 import packaging.version
 import numpy as np
 from numpy.linalg import norm
-import matplotlib.pyplot as plt
 import cv2
 from cv2 import aruco
 
-# handle incompatibility introduced in openCV 4.8
-if packaging.version.parse(cv2.__version__) < packaging.version.parse('4.8'):
+# handle incompatibility introduced in openCV 4.8, checked once at start
+OPENCV_LEGACY = packaging.version.parse(cv2.__version__) < packaging.version.parse('4.8')
+if OPENCV_LEGACY:
     aruco.extendDictionary = aruco.Dictionary_create
     aruco.getPredefinedDictionary = aruco.Dictionary_get
     aruco.DetectorParameters = aruco.DetectorParameters_create
 
-class GcpFind():
-    """ class to collect GCPs on an image """
+def cpu_count():
+    """ number of CPUs usable by this process
+
+        :return: number of usable CPUs
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def params_to_dict(params):
+    """ collect ArUco detection parameters into a dictionary
+
+        :param params: ArUco detector parameters
+        :return: dictionary of simple typed parameters
+    """
+    par_dict = {}
+    for par in dir(params):
+        if not par.startswith('__'):
+            val = getattr(params, par)
+            if type(val) in (int, float, str, bool):
+                par_dict[par] = val
+    return par_dict
+
+def dict_to_params(par_dict):
+    """ create ArUco detection parameters from a dictionary
+
+        :param par_dict: dictionary of parameters (e.g. from params_to_dict)
+        :return: ArUco detector parameters
+    """
+    params = aruco.DetectorParameters()
+    for par, val in par_dict.items():
+        setattr(params, par, val)
+    return params
+
+def parse_ids(text):
+    """ parse a list of marker ids, ranges can be given by a hyphen
+
+        :param text: comma separated list of ids and ranges (e.g. 1-12,20)
+        :return: sorted list of unique ids
+    """
+    ids = set()
+    for item in text.split(','):
+        if '-' in item.strip()[1:]:
+            first, last = item.strip().split('-', 1)
+            ids.update(range(int(first), int(last) + 1))
+        elif item.strip():
+            ids.add(int(item))
+    if not ids or min(ids) < 0:
+        raise ValueError(f'invalid marker ids: {text}')
+    return sorted(ids)
+
+def dict_list(text):
+    """ parse comma separated list of dictionary ids
+
+        :param text: dictionary ids separated by comma (e.g. 99,1)
+        :return: list of dictionary ids
+    """
+    try:
+        dicts = [int(item) for item in text.split(',')]
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f'invalid dictionary list: {text}') from e
+    if len(set(dicts)) < len(dicts):
+        raise argparse.ArgumentTypeError(f'repeated dictionary: {text}')
+    return dicts
+
+def shard_spec(text):
+    """ parse shard specification
+
+        :param text: shard index and number of shards (e.g. 2/8)
+        :return: tuple of shard index (starting from 1) and number of shards
+    """
+    try:
+        k, n = [int(item) for item in text.split('/')]
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f'invalid shard: {text}') from e
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError(f'shard index out of range: {text}')
+    return k, n
+
+def server_address(text):
+    """ parse server address
+
+        :param text: path to Unix domain socket or host:port
+        :return: tuple of socket family and address
+    """
+    host, sep, port = text.rpartition(':')
+    if sep and '/' not in text:
+        try:
+            return socket.AF_INET, (host if host else 'localhost', int(port))
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(f'invalid port: {text}') from e
+    if not hasattr(socket, 'AF_UNIX'):
+        raise argparse.ArgumentTypeError(f'Unix domain sockets are not supported: {text}')
+    return socket.AF_UNIX, text
+
+def min_distance(bytes_list, marker_size):
+    """ minimal Hamming distance of markers of a dictionary, rotations of
+        markers are considered as in OpenCV
+
+        :param bytes_list: byte list of markers (n x 4 x bytes)
+        :param marker_size: number of bits on a marker side
+        :return: minimal distance among markers and their rotations
+    """
+    bits = np.array([aruco.Dictionary.getBitsFromByteList(bytes_list[i:i+1], marker_size)
+                     for i in range(bytes_list.shape[0])], bool)
+    rots = np.stack([np.rot90(bits, r, axes=(1, 2)) for r in range(4)], 1)
+    rots = rots.reshape(bits.shape[0], 4, -1)
+    # distances of each marker to all rotations of each marker
+    dist = (rots[:, None, None, 0, :] != rots[None, :, :, :]).sum(axis=3)
+    n = bits.shape[0]
+    # the unrotated marker itself is not counted
+    dist[np.arange(n), np.arange(n), 0] = marker_size * marker_size
+    return int(dist.min())
+
+class MarkerDetector():
+    """ class to find ArUco markers on a single image,
+        it holds no state of the processed images, so it can be used in
+        worker processes
+    """
     LUT_IN = [0, 158, 216, 255]
     LUT_OUT = [0, 22, 80, 176]
+    # decode flags for reduced images
+    REDUCED = {2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+               4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+               8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+    # image reduction of coarse quality levels in deadline mode
+    LEVEL_SCALES = [4, 2]
+    LEVEL_MIN_SIZE = 480    # min size of reduced image for a coarse level
+    # marker ids of further dictionaries are shifted by this value
+    DICT_STRIDE = 10000
+    SIZE_HALF = 20          # marker size in pixels with half size score
+    CELL_MIN = 8            # cell size in pixels surely decoded on reduced images
 
-    def __init__(self, args, params):
-        """ Initialize GcpFind object
+    def __init__(self, args, params, coords=None, camera=None):
+        """ Initialize MarkerDetector object
 
             :param args: processed command line parameters
             :param params: aruco find params
+            :param coords: GCP coordinates to predict GCP positions on images
+            :param camera: camera model (see CameraModel.needed) or None
         """
         self.args = args
+        self.coords = coords if coords is not None else {}
+        self.profiler = Profiler() if args.profile else NullProfiler()
+        self.camera = camera
         # prepare aruco
-        if args.dict == 99:     # use special 3x3 dictionary
-            self.aruco_dict = aruco.extendDictionary(32, 3)
+        self.aruco_dicts = [self.get_dictionary(dict_id) for dict_id in args.dict]
+        # ids of reduced dictionary, detected indices are mapped back by it
+        self.id_map = None
+        if args.subdict or args.ids:
+            self.id_map = np.array(parse_ids(args.ids) if args.ids
+                                   else sorted(self.coords), np.int32)
+            for aruco_dict in self.aruco_dicts:
+                if self.id_map.size == 0 or \
+                   self.id_map[-1] >= aruco_dict.bytesList.shape[0]:
+                    raise ValueError('marker ids out of dictionary')
+                # correction bits are kept from the whole dictionary
+                aruco_dict.bytesList = aruco_dict.bytesList[self.id_map]
+        self.aruco_dict = self.aruco_dicts[0]
+        # cell size of the marker with the most bits
+        self.marker_bits = max(d.markerSize for d in self.aruco_dicts)
+        # several dictionaries in a single detection if OpenCV supports it
+        self.multi_dict = len(self.aruco_dicts) > 1 and \
+                          hasattr(aruco.ArucoDetector, 'detectMarkersMultiDict')
+        self.params = params
+        # decode strategy, color image is needed in debug mode
+        if args.debug or args.decode == 'color':
+            self.decode = 'color'
+        elif args.decode == 'reduced' and args.scale > 1:
+            self.decode = 'reduced'
+        else:
+            self.decode = 'gray'
+        # build detector once, it is reused for all images
+        self.detector = self.make_detector(self.params)
+        self.base = (self.detector, self.params)
+        # escalation passes, tuple of detector, params and adjust
+        self.passes = [(self.detector, self.params, args.adjust)]
+        self.ladder = []
+        if args.escalate:
+            with open(args.escalate, encoding='ascii') as f:
+                self.ladder = json.load(f)
+            for par_dict in self.ladder:
+                pars = params_to_dict(self.params)
+                pars.update({par: val for par, val in par_dict.items() if par != 'adjust'})
+                pass_params = dict_to_params(pars)
+                self.passes.append((self.make_detector(pass_params), pass_params,
+                                    par_dict.get('adjust', args.adjust)))
+        self.pass_no = 0            # actual escalation pass
+        self.params_key = None      # key of image specific parameters
+        self.gsd_params = {}        # detectors for marker and image sizes
+        # coarse detectors and detection time per megapixel of quality levels
+        self.levels = self.quality_levels() if args.deadline_ms else []
+        self.level_cost = {}
+        # detectors for tiles in each thread
+        self.local = threading.local()
+        # lookup table for color correction
+        self.lut = np.interp(np.arange(0, 256), self.LUT_IN,
+                             self.LUT_OUT).astype(np.uint8)
+
+    @staticmethod
+    def get_dictionary(dict_id):
+        """ create an ArUco dictionary
+
+            :param dict_id: id of dictionary, 99 for the custom 3x3 dictionary
+            :return: ArUco dictionary
+        """
+        if dict_id == 99:     # use special 3x3 dictionary
+            return aruco.extendDictionary(32, 3)
+        return aruco.getPredefinedDictionary(dict_id)
+
+    def make_detector(self, params):
+        """ create detector for the dictionaries, in case of several
+            dictionaries and no multi dictionary support a list of
+            detectors is created
+
+            :param params: ArUco parameters
+            :return: ArUco detector, list of detectors or None for OpenCV before 4.8
+        """
+        if OPENCV_LEGACY:
+            return None
+        with self.profiler.stage('detector'):
+            if len(self.aruco_dicts) == 1:
+                return aruco.ArucoDetector(self.aruco_dict, params)
+            if self.multi_dict:
+                return aruco.ArucoDetector(self.aruco_dicts, params)
+            return [aruco.ArucoDetector(d, params) for d in self.aruco_dicts]
+
+    def dict_tag(self, ids):
+        """ split marker ids to dictionary ids and marker ids
+
+            :param ids: marker ids shifted by the index of dictionary
+            :return: tuple of dictionary ids and marker ids in the dictionary
+        """
+        index, ids = np.divmod(ids, self.DICT_STRIDE)
+        return np.array(self.args.dict)[index], ids
+
+    def cache_key(self):
+        """ collect everything which influences the detection result
+
+            :return: dictionary of detection settings
+        """
+        par_str = json.dumps(params_to_dict(self.passes[0][1]), sort_keys=True)
+        return {'opencv': cv2.__version__,
+                'dict': self.args.dict,
+                'adjust': self.args.adjust,
+                'scale': [self.args.scale, self.CELL_MIN],
+                'decode': self.decode,
+                'tile': self.args.tile,
+                'maxmarker': self.args.maxmarker,
+                'fast': self.args.fast,
+                'roi': self.args.roisigma if self.args.roi else None,
+                'gsd': [self.args.markercm, self.args.gsd]
+                       if self.args.markercm is not None else None,
+                # predicted GCPs drive roi windows, fallbacks and escalation
+                'camera': [self.args.swidth, self.args.focal, self.args.height,
+                           self.args.camera, self.args.epsg, self.args.sensordb,
+                           self.args.margin, sorted(self.coords.items())]
+                          if self.camera is not None else None,
+                'expect': self.args.expect,
+                'escalate': self.ladder,
+                'deadline': bool(self.args.deadline_ms),
+                'ids': None if self.id_map is None else self.id_map.tolist(),
+                'score': bool(self.args.best),
+                'params': hashlib.sha256(par_str.encode()).hexdigest()}
+
+    def read_image(self, image_name, full=False):
+        """ read image from file, depending on decode strategy color, gray
+            or reduced gray image is read
+
+            :param image_name: path to image to read
+            :param full: read full resolution image in reduced decode strategy
+            :return: image or None in case of error
+        """
+        if self.decode == 'color':
+            flag = cv2.IMREAD_COLOR
+        elif self.decode == 'reduced' and not full:
+            flag = self.REDUCED[self.args.scale]
+        else:
+            flag = cv2.IMREAD_GRAYSCALE
+        if not self.profiler.enabled:
+            return cv2.imread(image_name, flag)
+        # file reading and decoding are measured separately
+        with self.profiler.stage('read', image_name):
+            try:
+                buf = np.fromfile(image_name, np.uint8)
+            except OSError:
+                return None
+        if buf.size == 0:
+            return None
+        with self.profiler.stage('decode', image_name):
+            frame = cv2.imdecode(buf, flag)
+        if frame is not None:
+            self.profiler.buffer('file', buf, image_name)
+            self.profiler.buffer('frame', frame, image_name)
+        return frame
+
+    def gray_image(self, frame):
+        """ convert image to gray for detection
+
+            :param frame: color or gray image
+            :return: gray image
+        """
+        if self.args.adjust:
+            # adjust colors for better recognition
+            with self.profiler.stage('lut'):
+                frame = cv2.LUT(frame, self.lut)
+        if frame.ndim == 2:
+            # image was read as gray
+            return frame
+        with self.profiler.stage('gray'):
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self.profiler.buffer('gray', gray)
+        return gray
+
+    def find(self, gray, detector=None, params=None, rejected=None):
+        """ find markers on a gray image using the ArUco detector
+
+            :param gray: gray image
+            :param detector: ArUco detector, default the detector of the object
+            :param params: ArUco parameters of detector, default the parameters of the object
+            :param rejected: list to collect corners of rejected marker candidates (n x 4 x 2), default None
+            :return: tuple of marker ids (n) and corners (n x 4 x 2)
+        """
+        if params is None:
+            detector = self.detector
+            params = self.params
+        with self.profiler.stage('detectMarkers'):
+            if self.multi_dict and detector is not None:
+                # candidates are extracted once for all dictionaries
+                corners, ids, cands, dict_index = detector.detectMarkersMultiDict(gray)
+                results = [(corners, ids, cands, dict_index)]
+            elif detector is None:
+                # several dictionaries are processed on the same gray image
+                results = [aruco.detectMarkers(gray, d, parameters=params)[:3] + (k,)
+                           for k, d in enumerate(self.aruco_dicts)]
+            elif isinstance(detector, list):
+                results = [det.detectMarkers(gray)[:3] + (k,)
+                           for k, det in enumerate(detector)]
+            else:
+                results = [detector.detectMarkers(gray)[:3] + (0,)]
+        ids_list = []
+        corners_list = []
+        for corners, ids, cands, dict_index in results:
+            if rejected is not None and cands is not None and len(cands):
+                rejected.append(np.array(cands, np.float32).reshape(-1, 4, 2))
+            if ids is None or len(ids) == 0:
+                continue
+            ids = ids.reshape(-1).astype(np.int32)
+            if self.id_map is not None:
+                # index in reduced dictionary to original id
+                ids = self.id_map[ids]
+            ids_list.append(ids + np.asarray(dict_index, np.int32).reshape(-1) * self.DICT_STRIDE)
+            corners_list.append(np.array(corners, np.float32).reshape(-1, 4, 2))
+        if not ids_list:
+            return np.zeros(0, np.int32), np.zeros((0, 4, 2), np.float32)
+        return np.concatenate(ids_list), np.concatenate(corners_list)
+
+    def search(self, gray, rejected=None):
+        """ find markers on a gray image, large images are processed in tiles
+
+            :param gray: gray image
+            :param rejected: list to collect corners of rejected marker candidates (n x 4 x 2), default None
+            :return: tuple of marker ids (n) and corners (n x 4 x 2)
+        """
+        if self.args.tile <= 0 or max(gray.shape) <= self.args.tile:
+            return self.find(gray, rejected=rejected)
+        h, w = gray.shape
+        tile = self.args.tile
+        # neighbouring tiles overlap by the max marker size
+        overlap = min(self.args.maxmarker, tile // 2)
+        step = tile - overlap
+        origins = [(x0, y0) for y0 in range(0, max(h - overlap, 1), step)
+                   for x0 in range(0, max(w - overlap, 1), step)]
+
+        def find_tile(origin):
+            """ find markers on a tile and shift them to image coordinates """
+            x0, y0 = origin
+            sub = gray[y0:y0+tile, x0:x0+tile]
+            detector, params = self.tile_detector(sub.shape, max(h, w))
+            cands = None if rejected is None else []
+            ids, corners = self.find(sub, detector, params, cands)
+            corners += np.array([x0, y0], np.float32)
+            if cands:
+                # list append is thread safe
+                rejected.extend(c + np.array([x0, y0], np.float32) for c in cands)
+            return ids, corners
+
+        if self.args.tilethreads > 1:
+            with ThreadPoolExecutor(self.args.tilethreads) as executor:
+                results = list(executor.map(find_tile, origins))
+        else:
+            results = [find_tile(origin) for origin in origins]
+        return self.merge(results, overlap / 2)
+
+    def tile_detector(self, shape, size):
+        """ get detector for a tile, relative size parameters are
+            modified to the tile size, detectors are stored for each thread
+
+            :param shape: shape of the tile
+            :param size: larger size of the whole image
+            :return: tuple of detector and params
+        """
+        if not hasattr(self.local, 'detectors'):
+            self.local.detectors = {}
+        key = (shape, self.params_key)
+        if key not in self.local.detectors:
+            par_dict = params_to_dict(self.params)
+            ratio = size / max(shape)
+            par_dict['minMarkerPerimeterRate'] *= ratio
+            par_dict['maxMarkerPerimeterRate'] *= ratio
+            par_dict['minMarkerLengthRatioOriginalImg'] = \
+                min(1.0, par_dict['minMarkerLengthRatioOriginalImg'] * ratio)
+            params = dict_to_params(par_dict)
+            self.local.detectors[key] = (self.make_detector(params), params)
+        return self.local.detectors[key]
+
+    @staticmethod
+    def merge(results, dist):
+        """ merge markers found on overlapping tiles, markers with the same
+            id and near centers are kept once
+
+            :param results: list of marker ids and corners on tiles
+            :param dist: max distance of centers of the same marker
+            :return: tuple of marker ids (n) and corners (n x 4 x 2)
+        """
+        ids_list = []
+        corners_list = []
+        for ids, corners in results:
+            for j, act in zip(ids, corners):
+                center = np.average(act, axis=0)
+                if not any(j == j1 and norm(np.average(c1, axis=0) - center) < dist
+                           for j1, c1 in zip(ids_list, corners_list)):
+                    ids_list.append(j)
+                    corners_list.append(act)
+        return np.array(ids_list, np.int32), \
+               np.array(corners_list, np.float32).reshape(-1, 4, 2)
+
+    def detect(self, gray, image_name=None, start=None):
+        """ find markers on a gray image, in deadline mode quality levels
+            are processed while the time budget allows
+
+            :param gray: gray image (reduced in case of reduced decode)
+            :param image_name: path to image to read metadata and full resolution image if necessary
+            :param start: start time of image processing (perf_counter) in deadline mode, default now
+            :return: tuple of marker ids (n), corners (n x 4 x 2) and a dictionary of detection info
+        """
+        if self.levels:
+            ids, corners, info = self.detect_deadline(gray, image_name, start)
         else:
-            self.aruco_dict = aruco.getPredefinedDictionary(args.dict)
+            ids, corners, info = self.detect_passes(gray, image_name)
+        if self.args.best:
+            info['score'] = self.quality_scores(gray, corners).tolist()
+        return ids, corners, info
+
+    def quality_scores(self, gray, corners):
+        """ quality score of markers from the marker size, the distance
+            from the image center, the regularity of corner angles and the
+            sharpness, the factors are in the range (0, 1], the score is
+            their product
+
+            :param gray: gray image (reduced in case of reduced decode)
+            :param corners: marker corners on the full resolution image (n x 4 x 2)
+            :return: array of scores (n)
+        """
+        factor = self.args.scale if self.decode == 'reduced' else 1
+        h, w = gray.shape
+        half_diag = math.hypot(w * factor, h * factor) / 2
+        scores = np.zeros(corners.shape[0])
+        # marker size as in Meshroom output
+        sizes = DetectionStore.sizes(corners).astype(np.float64)
+        for i, c in enumerate(corners.astype(np.float64)):
+            size_f = sizes[i] / (sizes[i] + self.SIZE_HALF)
+            # lens distortion is larger at the image border
+            center = c.mean(axis=0)
+            dist = math.hypot(center[0] - w * factor / 2, center[1] - h * factor / 2)
+            center_f = 1 - 0.5 * min(1, dist / half_diag)
+            # deviation of corner angles from the right angle
+            v1 = np.roll(c, -1, axis=0) - c
+            v2 = np.roll(c, 1, axis=0) - c
+            cos = (v1 * v2).sum(axis=1) / np.maximum(norm(v1, axis=1) * norm(v2, axis=1), 1e-9)
+            dev = np.abs(np.arccos(np.clip(cos, -1, 1)) - math.pi / 2)
+            angle_f = max(0.0, 1 - dev.mean() / (math.pi / 2))
+            # variance of Laplacian relative to the contrast of the marker
+            x0, y0 = np.maximum(np.floor(c.min(axis=0) / factor).astype(int), 0)
+            x1, y1 = np.ceil(c.max(axis=0) / factor).astype(int) + 1
+            patch = gray[y0:y1, x0:x1]
+            if patch.shape[0] < 3 or patch.shape[1] < 3:
+                continue
+            sharp = cv2.Laplacian(patch, cv2.CV_32F).var() / max(float(patch.var()), 1.0)
+            sharp_f = sharp / (1 + sharp)
+            scores[i] = size_f * center_f * angle_f * sharp_f
+        return scores
+
+    def quality_levels(self):
+        """ create detectors of the coarse quality levels of deadline mode,
+            the first level uses a single threshold window, the second one
+            all windows of the parameters, corners are refined on the
+            original image
+
+            :return: list of (scale, detector, params) tuples
+        """
+        par_dict = params_to_dict(self.params)
+        par_dict['cornerRefinementMethod'] = 0
+        wins = list(range(par_dict['adaptiveThreshWinSizeMin'],
+                          par_dict['adaptiveThreshWinSizeMax'] + 1,
+                          max(1, par_dict['adaptiveThreshWinSizeStep'])))
+        narrow = dict(par_dict)
+        narrow['adaptiveThreshWinSizeMin'] = wins[len(wins) // 2]
+        narrow['adaptiveThreshWinSizeMax'] = wins[len(wins) // 2]
+        levels = []
+        for scale, pars in zip(self.LEVEL_SCALES, (narrow, par_dict)):
+            params = dict_to_params(pars)
+            levels.append((scale, self.make_detector(params), params))
+        return levels
+
+    def detect_deadline(self, gray, image_name=None, start=None):
+        """ find markers within the time budget, a coarse detection is made
+            on a reduced image first, finer quality levels are run if their
+            estimated time fits in the remaining budget, the last level is
+            the detection by the parameters given, markers found on finer
+            levels are preferred
+
+            :param gray: gray image
+            :param image_name: path to image to read metadata
+            :param start: start time of image processing (perf_counter), default now
+            :return: tuple of marker ids (n), corners (n x 4 x 2) and a dictionary of detection info, quality level reached is in info
+        """
+        if start is None:
+            start = time.perf_counter()
+        deadline = start + self.args.deadline_ms / 1000
+        mpix = gray.size / 1e6
+        results = []
+        info = {}
+        last = None         # time and scale of the last level processed
+        for k in range(len(self.levels) + 1):
+            if k < len(self.levels):
+                scale, detector, params = self.levels[k]
+                if scale <= self.args.scale or max(gray.shape) // scale < self.LEVEL_MIN_SIZE:
+                    continue    # level would not be faster than the final one
+            else:
+                scale = self.args.scale
+            t1 = time.perf_counter()
+            if results:
+                if k in self.level_cost:
+                    estimate = self.level_cost[k] * mpix
+                else:
+                    # extrapolate from the previous level by the pixel count
+                    estimate = last[0] * (last[1] / scale) ** 2
+                if t1 + estimate > deadline:
+                    break
+            if k < len(self.levels):
+                with self.profiler.stage('reduce'):
+                    small = cv2.resize(gray, (gray.shape[1] // scale, gray.shape[0] // scale),
+                                       interpolation=cv2.INTER_AREA)
+                ids, corners = self.find(small, detector, params)
+                corners = self.refine(gray, self.upscale(corners, scale), scale + 1)
+            else:
+                ids, corners, info = self.detect_passes(gray, image_name)
+            elapsed = time.perf_counter() - t1
+            if k in self.level_cost:
+                self.level_cost[k] = 0.7 * self.level_cost[k] + 0.3 * elapsed / mpix
+            else:
+                self.level_cost[k] = elapsed / mpix
+            last = (elapsed, scale)
+            results.append((ids, corners))
+            info['quality'] = k
+        ids, corners = self.merge_passes(results[::-1])
+        return ids, corners, info
+
+    def detect_passes(self, gray, image_name=None):
+        """ find markers on a gray image, in roi mode markers are searched
+            in windows around the predicted GCP positions first, further
+            escalation passes are run if the result is incomplete
+
+            :param gray: gray image (reduced in case of reduced decode)
+            :param image_name: path to image to read metadata and full resolution image if necessary
+            :return: tuple of marker ids (n), corners (n x 4 x 2) and a dictionary of detection info
+        """
+        ids, corners, info = self.detect_pass(gray, image_name)
+        if len(self.passes) == 1:
+            return ids, corners, info
+        expected = None
+        if self.can_predict() and image_name is not None:
+            preds = self.predict(image_name, gray.shape)
+            if preds is not None:
+                expected = len(preds)
+        results = [(ids, corners)]
+        info['pass'] = 0
+        orig = gray
+        for k in range(1, len(self.passes)):
+            if not self.incomplete(ids, expected):
+                break
+            self.use_pass(k)
+            if self.passes[k][2] and not self.args.adjust:
+                # adjust colors in this pass only
+                gray = cv2.LUT(orig, self.lut)
+            else:
+                gray = orig
+            pass_ids, pass_corners, pass_info = self.detect_pass(gray, image_name)
+            results.append((pass_ids, pass_corners))
+            ids, corners = self.merge_passes(results)
+            info.update(pass_info)
+            info['pass'] = k
+        self.use_pass(0)
+        return ids, corners, info
+
+    def use_pass(self, pass_no):
+        """ switch to the detector of an escalation pass
+
+            :param pass_no: index of pass
+        """
+        self.pass_no = pass_no
+        self.base = self.passes[pass_no][:2]
+        self.detector, self.params = self.base
+        self.params_key = None if pass_no == 0 else (pass_no,)
+
+    def incomplete(self, ids, expected):
+        """ check if the result of a pass needs escalation
+
+            :param ids: marker ids found
+            :param expected: number of GCPs predicted on the image or None
+            :return: True if there are duplicates, less markers than
+                     predicted or no markers on an image near GCPs
+        """
+        if ids.size == 0:
+            return expected is None or expected > 0
+        if len(np.unique(ids)) < ids.size:
+            return True
+        if expected is None:
+            return False
+        if self.coords:
+            # markers of known GCPs
+            return np.isin(ids % self.DICT_STRIDE, list(self.coords)).sum() < expected
+        return ids.size < expected
+
+    @staticmethod
+    def merge_passes(results):
+        """ merge markers found by passes by id, a marker is taken from
+            the first pass which found it once, or from the first pass which
+            found it if it is duplicated in all passes
+
+            :param results: list of (ids, corners) tuples of passes
+            :return: tuple of merged ids and corners
+        """
+        merged = {}
+        for ids, corners in results:
+            for j in dict.fromkeys(ids.tolist()):
+                sel = ids == j
+                if j not in merged or (merged[j].shape[0] > 1 and sel.sum() == 1):
+                    merged[j] = corners[sel]
+        if not merged:
+            return results[0]
+        ids = np.concatenate([np.full(c.shape[0], j, np.int32) for j, c in merged.items()])
+        corners = np.concatenate(list(merged.values())).astype(np.float32)
+        return ids, corners
+
+    def detect_pass(self, gray, image_name=None):
+        """ find markers on a gray image with the actual detector
+
+            :param gray: gray image (reduced in case of reduced decode)
+            :param image_name: path to image to read metadata and full resolution image if necessary
+            :return: tuple of marker ids (n), corners (n x 4 x 2) and a dictionary of detection info
+        """
+        info = {}
+        if self.args.markercm is not None or self.args.fast:
+            info['marker_px'] = self.set_image_params(image_name, gray.shape)
+        preds = None
+        if self.can_predict() and image_name is not None and \
+           (self.args.roi or self.args.scale > 1):
+            preds = self.predict(image_name, gray.shape)
+        if self.args.roi and preds is not None:
+            ids, corners, info['offsets'], missing = self.find_roi(gray, preds)
+            if self.decode == 'reduced':
+                corners = self.upscale(corners, self.args.scale)
+            if not missing:
+                return ids, corners, info
+            # fall back to the whole image
+            info['missing'] = missing
+        ids, corners = self.detect_markers(gray, image_name,
+                                           None if preds is None else len(preds))
+        return ids, corners, info
+
+    def marker_size(self, image_name, shape):
+        """ estimate marker size on image from the ground sample distance
+
+            :param image_name: path to image
+            :param shape: shape of the gray image
+            :return: marker side size in pixels or None if GSD is unknown
+        """
+        if self.args.gsd is not None:
+            # gsd is given for the original image
+            factor = self.args.scale if self.decode == 'reduced' else 1
+            return self.args.markercm / self.args.gsd / factor
+        if image_name is None:
+            return None
+        pose = self.camera.image_pose(image_name)
+        if pose is None:
+            return None
+        if self.args.height is not None:
+            height = self.args.height
+        elif self.coords:
+            height = pose['alt'] - np.mean([float(coo[2]) for coo in self.coords.values()])
+        else:
+            return None
+        if height <= 0:
+            return None
+        gsd = self.camera.gsd(pose, height) * 100 * pose['width'] / shape[1]
+        return self.args.markercm / gsd
+
+    def set_image_params(self, image_name, shape):
+        """ set marker size and threshold window parameters of the detector
+            from the expected marker size on the image and the downsampling
+            ratio of ArUco3 detection in fast mode
+
+            :param image_name: path to image
+            :param shape: shape of the gray image
+            :return: expected marker size in pixels or None if unknown
+        """
+        size = None
+        if self.args.markercm is not None:
+            size = self.marker_size(image_name, shape)
+        if size is None and not self.args.fast:
+            self.detector, self.params = self.base
+            self.params_key = None if self.pass_no == 0 else (self.pass_no,)
+            return None
+        if self.decode != 'reduced' and self.args.scale > 1:
+            factor = self.args.scale    # search on reduced image
+        else:
+            factor = 1
+        key = (self.pass_no, None if size is None else int(round(size / factor)), max(shape))
+        if key not in self.gsd_params:
+            par_dict = params_to_dict(self.base[1])
+            if size is not None:
+                size_search = size / factor
+                bits = self.marker_bits + 2 * par_dict['markerBorderBits']
+                perimeter = 4 * size / max(shape)
+                # 40% smaller and 60% larger markers are accepted (tilt, altitude error)
+                par_dict['minMarkerPerimeterRate'] = 0.6 * perimeter
+                par_dict['maxMarkerPerimeterRate'] = 1.6 * perimeter
+            if self.args.fast and self.args.lengthratio == 0:
+                # downsample the smallest expected marker to minside pixels
+                max_search = max(shape) / factor
+                min_side = par_dict['minMarkerPerimeterRate'] * max_search / 4
+                minside = par_dict['minSideLengthCanonicalImg']
+                if min_side > minside:
+                    par_dict['minMarkerLengthRatioOriginalImg'] = \
+                        (min_side - minside) / max_search
+                else:
+                    # image cannot be downsampled, ArUco3 would lose markers
+                    par_dict['useAruco3Detection'] = False
+                if size is not None:
+                    # thresholding is made on the downsampled image
+                    size_search *= minside / max(minside, min_side)
+            if size is not None:
+                # threshold windows from the cell size to the half marker size
+                winmin = max(3, int(size_search / bits) | 1)
+                winmax = max(winmin, int(size_search / 2) | 1)
+                par_dict['adaptiveThreshWinSizeMin'] = winmin
+                par_dict['adaptiveThreshWinSizeMax'] = winmax
+                par_dict['adaptiveThreshWinSizeStep'] = max(2, winmax - winmin)
+            params = dict_to_params(par_dict)
+            self.gsd_params[key] = (self.make_detector(params), params)
+        self.detector, self.params = self.gsd_params[key]
+        self.params_key = key
+        return size
+
+    def can_predict(self):
+        """ check if GCP positions can be predicted on images
+
+            :return: True if camera model, GCP coordinates and their transformation are available
+        """
+        return self.camera is not None and self.camera.transformer is not None and \
+               bool(self.coords)
+
+    def predict(self, image_name, shape):
+        """ predict the position of GCPs on the image from the EXIF position
+            and camera yaw of the image
+
+            :param image_name: path to image
+            :param shape: shape of the gray image
+            :return: list of GCP id, x, y and half window size tuples or None if position or yaw is unknown
+        """
+        import exif_pos
+        if not self.can_predict():
+            return None
+        pose = self.camera.image_pose(image_name)
+        if pose is None or pose['east'] is None:
+            return None
+        try:
+            yaw = exif_pos.img_yaw(image_name)
+        except OSError:
+            yaw = None
+        if yaw is None:
+            return None
+        h, w = shape
+        factor = w / pose['width']      # in case of reduced image
+        sin_yaw = math.sin(math.radians(yaw))
+        cos_yaw = math.cos(math.radians(yaw))
+        preds = []
+        for j, coo in self.coords.items():
+            if self.args.height is not None:
+                height = self.args.height
+            else:
+                height = pose['alt'] - float(coo[2])
+            if height <= 0:
+                continue
+            gsd = self.camera.gsd(pose, height) / factor
+            de = float(coo[0]) - pose['east']
+            dn = float(coo[1]) - pose['north']
+            # image up is the yaw direction
+            x = w / 2 + (de * cos_yaw - dn * sin_yaw) / gsd
+            y = h / 2 - (de * sin_yaw + dn * cos_yaw) / gsd
+            half = self.args.roisigma / gsd + self.args.maxmarker * factor / 2
+            if -half < x < w + half and -half < y < h + half:
+                preds.append((j, x, y, half))
+        return preds
+
+    def find_roi(self, gray, preds):
+        """ find markers in windows around predicted GCP positions
+
+            :param gray: gray image
+            :param preds: predicted GCP positions (see predict)
+            :return: tuple of marker ids, corners, list of GCP id and x, y
+                     offsets between found and predicted positions and
+                     list of GCP ids not found
+        """
+        h, w = gray.shape
+        results = []
+        for _, x, y, half in preds:
+            x0 = max(0, int(x - half))
+            x1 = min(w, int(x + half) + 1)
+            y0 = max(0, int(y - half))
+            y1 = min(h, int(y + half) + 1)
+            if x1 - x0 < 16 or y1 - y0 < 16:
+                continue        # window is out of image
+            sub = gray[y0:y1, x0:x1]
+            detector, params = self.tile_detector(sub.shape, max(h, w))
+            ids, corners = self.find(sub, detector, params)
+            corners += np.array([x0, y0], np.float32)
+            results.append((ids, corners))
+        ids, corners = self.merge(results, self.args.maxmarker / 2)
+        offsets = []
+        missing = []
+        for j, x, y, _ in preds:
+            found = np.nonzero(ids % self.DICT_STRIDE == j)[0]
+            if found.size:
+                center = np.average(corners[found[0]], axis=0)
+                offsets.append((j, float(center[0] - x), float(center[1] - y)))
+            else:
+                missing.append(j)
+        return ids, corners, offsets, missing
+
+    def detect_markers(self, gray, image_name=None, expected=None):
+        """ find markers on a gray image, in scale mode markers are searched
+            on a reduced image first and corners are refined on the
+            original image, rejected candidates of the reduced image are
+            checked on the original image, the whole original image is
+            searched if less markers found than expected
+
+            :param gray: gray image (reduced in case of reduced decode)
+            :param image_name: path to image to read full resolution image if necessary
+            :param expected: number of GCPs predicted on the image or None
+            :return: tuple of marker ids (n) and corners (n x 4 x 2)
+        """
+        scale = self.args.scale
+        if scale == 1:
+            return self.search(gray)
+        if self.decode == 'reduced':
+            small = gray
+            gray = None
+        else:
+            with self.profiler.stage('reduce'):
+                small = cv2.resize(gray, (gray.shape[1] // scale, gray.shape[0] // scale),
+                                   interpolation=cv2.INTER_AREA)
+        rejected = []
+        ids, corners = self.search(small, rejected)
+        cands = self.candidates(corners, rejected)
+        fallback = self.too_few(ids, expected)
+        if gray is None and (fallback or cands.size) and image_name is not None:
+            full = self.read_image(image_name, True)
+            if full is not None:
+                gray = self.gray_image(full)
+        if gray is None:
+            # no full resolution image, refine on reduced image
+            return ids, self.upscale(self.refine(small, corners, 2), scale)
+        if fallback:
+            # fall back to full resolution
+            return self.search(gray)
+        corners = self.refine(gray, self.upscale(corners, scale), scale + 1)
+        if cands.size:
+            # markers too small to decode on the reduced image
+            cand_ids, cand_corners = self.check_candidates(gray, self.upscale(cands, scale))
+            ids, corners = self.merge([(ids, corners),
+                                       (cand_ids, self.refine(gray, cand_corners, 2))],
+                                      self.args.maxmarker / 2)
+        return ids, corners
+
+    def too_few(self, ids, expected):
+        """ check if less markers found on the reduced image than expected
+
+            :param ids: marker ids found
+            :param expected: number of GCPs predicted on the image or None
+            :return: True if the whole original image should be searched
+        """
+        if ids.size < self.args.expect:
+            return True
+        if expected is None or not self.coords:
+            return False
+        # markers of known GCPs
+        return np.isin(ids % self.DICT_STRIDE, list(self.coords)).sum() < expected
+
+    def candidates(self, corners, rejected):
+        """ select rejected candidates of a reduced image which are too
+            small to decode there and do not overlap the markers found
+
+            :param corners: corners of markers found (n x 4 x 2)
+            :param rejected: list of corners of rejected candidates (m x 4 x 2)
+            :return: corners of candidates to check (k x 4 x 2)
+        """
+        if not rejected:
+            return np.zeros((0, 4, 2), np.float32)
+        cands = np.concatenate(rejected)
+        # larger candidates would have been decoded on the reduced image
+        sides = norm(cands - np.roll(cands, 1, axis=1), axis=2).max(axis=1)
+        cands = cands[sides < (self.marker_bits + 2) * self.CELL_MIN]
+        if corners.shape[0]:
+            # candidates inside markers found are parts of markers
+            centers = cands.mean(axis=1)
+            inside = np.zeros(cands.shape[0], bool)
+            for c in corners:
+                lo = c.min(axis=0)
+                hi = c.max(axis=0)
+                inside |= np.all((centers >= lo) & (centers <= hi), axis=1)
+            cands = cands[~inside]
+        return cands
+
+    def check_candidates(self, gray, cands):
+        """ find markers in windows around candidates on the original image
+
+            :param gray: original gray image
+            :param cands: candidate corners on the original image (n x 4 x 2)
+            :return: tuple of marker ids (n) and corners (n x 4 x 2)
+        """
+        h, w = gray.shape
+        results = []
+        with self.profiler.stage('candidates'):
+            for c in cands:
+                lo = c.min(axis=0)
+                hi = c.max(axis=0)
+                # window of twice the candidate size, rounded to reuse detectors
+                size = int(-(-2 * max(hi - lo) // 32) * 32) + 32
+                x, y = (lo + hi) / 2
+                x0 = int(min(max(0, x - size / 2), max(0, w - size)))
+                y0 = int(min(max(0, y - size / 2), max(0, h - size)))
+                sub = gray[y0:y0+size, x0:x0+size]
+                detector, params = self.tile_detector(sub.shape, max(h, w))
+                ids, corners = self.find(sub, detector, params)
+                corners += np.array([x0, y0], np.float32)
+                results.append((ids, corners))
+        return self.merge(results, self.args.maxmarker / 2)
+
+    @staticmethod
+    def upscale(corners, scale):
+        """ transform corners from a reduced image to full resolution
+
+            :param corners: marker corners on reduced image (n x 4 x 2)
+            :param scale: reduction factor of the image
+            :return: corners on full resolution image (n x 4 x 2)
+        """
+        # pixel centers of the reduced image to full resolution
+        return ((corners + 0.5) * scale - 0.5).astype(np.float32)
+
+    def refine(self, gray, corners, win):
+        """ refine corners on small windows of an image
+
+            :param gray: gray image
+            :param corners: approximate marker corners (n x 4 x 2)
+            :param win: half size of search window
+            :return: refined corners (n x 4 x 2)
+        """
+        if corners.shape[0] == 0:
+            return corners
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER,
+                    self.params.cornerRefinementMaxIterations,
+                    self.params.cornerRefinementMinAccuracy)
+        with self.profiler.stage('refine'):
+            pts = cv2.cornerSubPix(gray, corners.reshape(-1, 1, 2), (win, win),
+                                   (-1, -1), criteria)
+        return pts.reshape(-1, 4, 2)
+
+    def detect_image(self, image_name):
+        """ find markers on an image file
+
+            :param image_name: path to image to process
+            :return: tuple of marker ids, corners and detection info or None if image cannot be read
+        """
+        start = time.perf_counter()     # reading is part of the time budget
+        self.profiler.begin(image_name)
+        frame = self.read_image(image_name)
+        if frame is None:
+            return None
+        return self.detect(self.gray_image(frame), image_name, start)
+
+class ImagePrefetcher():
+    """ read images in background threads ahead of processing,
+        images are yielded in the order of names
+    """
+
+    def __init__(self, names, read_func, depth=2, readers=1, max_mpix=0):
+        """ Initialize ImagePrefetcher object
+
+            :param names: list of image paths to read
+            :param read_func: function to read an image from a path
+            :param depth: max number of images read ahead
+            :param readers: number of reader threads
+            :param max_mpix: max megapixels in flight, 0 for no limit
+        """
+        self.names = names
+        self.read_func = read_func
+        self.depth = max(1, depth)
+        self.readers = max(1, readers)
+        self.max_mpix = max_mpix
+        self.cond = threading.Condition()
+        self.images = {}        # images read but not consumed yet
+        self.next_read = 0      # index of next image to read
+        self.next_yield = 0     # index of next image to yield
+        self.pixels = 0         # pixels in flight
+        self.est_pixels = 0     # estimated size of next image
+        self.stop = False
+
+    def can_read(self):
+        """ check whether a reader thread can start to read the next image
+
+            :return: True if the next image can be read
+        """
+        if self.next_read >= len(self.names) or \
+           self.next_read - self.next_yield >= self.depth:
+            return False
+        if self.max_mpix > 0 and self.next_read > self.next_yield and \
+           self.pixels + self.est_pixels > self.max_mpix * 1e6:
+            return False
+        return True
+
+    def reader(self):
+        """ reader thread, reads images while there are unread ones """
+        while True:
+            with self.cond:
+                while not self.stop and not self.can_read():
+                    if self.next_read >= len(self.names):
+                        return
+                    self.cond.wait()
+                if self.stop:
+                    return
+                i = self.next_read
+                self.next_read += 1
+                est = self.est_pixels
+                self.pixels += est
+            t1 = time.perf_counter()
+            img = None
+            try:
+                img = self.read_func(self.names[i])
+            except Exception as e:
+                # failed read is yielded as unreadable image
+                print(f'error reading image {self.names[i]}: {e}', file=sys.stderr)
+            finally:
+                elapsed = time.perf_counter() - t1
+                with self.cond:
+                    act = 0 if img is None else img.shape[0] * img.shape[1]
+                    self.pixels += act - est
+                    if act > 0:
+                        self.est_pixels = act
+                    self.images[i] = (img, act, elapsed)
+                    self.cond.notify_all()
+
+    def __iter__(self):
+        """ start reader threads and yield images in order
+
+            :return: generator of (image name, image, read time in seconds) tuples
+        """
+        threads = [threading.Thread(target=self.reader, daemon=True)
+                   for _ in range(min(self.readers, len(self.names)))]
+        for thread in threads:
+            thread.start()
+        try:
+            for i, name in enumerate(self.names):
+                with self.cond:
+                    while i not in self.images:
+                        self.cond.wait()
+                    img, act, elapsed = self.images.pop(i)
+                    self.next_yield = i + 1
+                    self.pixels -= act
+                    self.cond.notify_all()
+                yield name, img, elapsed
+        finally:
+            with self.cond:
+                self.stop = True
+                self.cond.notify_all()
+
+class DetectionCache():
+    """ persistent cache of markers found on images in an SQLite database,
+        the key of an image is built from the file identity and
+        the detection settings
+    """
+
+    def __init__(self, path, max_size, content_hash=False):
+        """ Initialize DetectionCache object
+
+            :param path: path to SQLite database file
+            :param max_size: max size of cached data in bytes
+            :param content_hash: use hash of image content instead of path and modification time
+        """
+        self.max_size = max_size
+        self.content_hash = content_hash
+        self.con = sqlite3.connect(path)
+        self.con.execute("""CREATE TABLE IF NOT EXISTS markers (
+                            key TEXT PRIMARY KEY, ids BLOB, corners BLOB,
+                            size INTEGER, used REAL)""")
+        self.con.execute("CREATE INDEX IF NOT EXISTS markers_used ON markers (used)")
+        # quality scores of markers (see MarkerDetector.quality_scores)
+        self.con.execute("""CREATE TABLE IF NOT EXISTS scores (
+                            key TEXT PRIMARY KEY, scores BLOB)""")
+        self.puts = 0
+
+    def image_key(self, image_name, settings):
+        """ create cache key for an image
+
+            :param image_name: path to image
+            :param settings: detection settings (see MarkerDetector.cache_key)
+            :return: cache key or None if image file is not available
+        """
+        try:
+            file_stat = os.stat(image_name)
+        except OSError:
+            return None
+        if self.content_hash:
+            sha = hashlib.sha256()
+            with open(image_name, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+            ident = [file_stat.st_size, sha.hexdigest()]
+        else:
+            ident = [file_stat.st_size, file_stat.st_mtime_ns, os.path.realpath(image_name)]
+        key_str = json.dumps([ident, settings], sort_keys=True)
+        return hashlib.sha256(key_str.encode()).hexdigest()
+
+    def get(self, key):
+        """ get cached result
+
+            :param key: cache key
+            :return: tuple of marker ids, corners and detection info (scores only) or None if not cached
+        """
+        if key is None:
+            return None
+        row = self.con.execute("SELECT ids, corners FROM markers WHERE key=?",
+                               (key,)).fetchone()
+        if row is None:
+            return None
+        self.con.execute("UPDATE markers SET used=? WHERE key=?",
+                         (time.time(), key))
+        info = {}
+        score = self.con.execute("SELECT scores FROM scores WHERE key=?",
+                                 (key,)).fetchone()
+        if score is not None:
+            info['score'] = np.frombuffer(score[0], np.float64).tolist()
+        return np.frombuffer(row[0], np.int32).copy(), \
+               np.frombuffer(row[1], np.float32).reshape(-1, 4, 2).copy(), info
+
+    def put(self, key, result):
+        """ store result in cache
+
+            :param key: cache key
+            :param result: tuple of marker ids, corners and detection info
+        """
+        if key is None:
+            return
+        ids = result[0].astype(np.int32).tobytes()
+        corners = result[1].astype(np.float32).tobytes()
+        self.con.execute("INSERT OR REPLACE INTO markers VALUES (?, ?, ?, ?, ?)",
+                         (key, ids, corners, len(key) + len(ids) + len(corners),
+                          time.time()))
+        if 'score' in result[2]:
+            self.con.execute("INSERT OR REPLACE INTO scores VALUES (?, ?)",
+                             (key, np.array(result[2]['score'], np.float64).tobytes()))
+        self.puts += 1
+        if self.puts % 100 == 0:
+            self.con.commit()
+
+    def evict(self):
+        """ remove least recently used entries if cache is over size limit """
+        total = self.con.execute("SELECT SUM(size) FROM markers").fetchone()[0]
+        if total is None or total <= self.max_size:
+            return
+        # remove entries till 90% of limit
+        to_free = total - 0.9 * self.max_size
+        keys = []
+        for key, size in self.con.execute("SELECT key, size FROM markers ORDER BY used"):
+            if to_free <= 0:
+                break
+            keys.append((key,))
+            to_free -= size
+        self.con.executemany("DELETE FROM markers WHERE key=?", keys)
+        self.con.executemany("DELETE FROM scores WHERE key=?", keys)
+        self.con.commit()
+        self.con.execute("VACUUM")
+
+    def close(self):
+        """ save changes, evict old entries and close database """
+        self.con.commit()
+        self.evict()
+        self.con.close()
+
+class DetectionJournal():
+    """ append only binary journal of markers found on images, it makes
+        interrupted runs resumable and it is the partial result of shards,
+        a record is written for each image with a CRC to detect partial
+        records of an interrupted write
+    """
+    MAGIC = b'GCPJOURNAL1\n'
+    # crc, length of image name, index of image in input, number of markers, flags
+    RECORD = struct.Struct('<IHiiB')
+    SCORES = 1          # flag of quality scores in record
+    SYNC_COUNT = 64     # max number of images between fsync
+    SYNC_TIME = 5.0     # max seconds between fsync
+
+    def __init__(self, path, settings):
+        """ Initialize DetectionJournal object
+
+            :param path: path to journal file
+            :param settings: detection settings (see MarkerDetector.cache_key) or None to read any journal
+        """
+        self.path = path
+        self.head = None
+        if settings is not None:
+            key_str = json.dumps(settings, sort_keys=True)
+            # dictionaries are necessary to split marker ids at merge
+            self.head = self.MAGIC + hashlib.sha256(key_str.encode()).hexdigest().encode() + \
+                        json.dumps({'dict': settings['dict']}).encode() + b'\n'
+        self.meta = None    # header data of journal read
+        self.digest = None  # hash of detection settings of journal read
+        self.valid = 0      # length of valid records in file
+        self.f = None
+        self.pending = 0    # images written since last fsync
+        self.synced = time.time()
+
+    def replay(self):
+        """ read records of journal, a partial record at the end is dropped
+
+            :return: list of (image name, index, ids, corners, info) tuples
+        """
+        if not os.path.isfile(self.path) or os.path.getsize(self.path) == 0:
+            return []
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(self.MAGIC):
+            raise ValueError('not a journal file')
+        if self.head is not None and not data.startswith(self.head):
+            raise ValueError('journal was written with other detection settings')
+        pos = data.find(b'\n', len(self.MAGIC)) + 1
+        if pos == 0:
+            raise ValueError('not a journal file')
+        self.digest = data[len(self.MAGIC):len(self.MAGIC)+64].decode()
+        self.meta = json.loads(data[len(self.MAGIC)+64:pos])
+        records = []
+        while pos + self.RECORD.size <= len(data):
+            crc, name_len, index, n, flags = self.RECORD.unpack_from(data, pos)
+            start = pos + self.RECORD.size
+            end = start + name_len + n * 36 + (n * 8 if flags & self.SCORES else 0)
+            if end > len(data) or zlib.crc32(data[pos+4:end]) != crc:
+                break       # interrupted write
+            off = start + name_len
+            ids = np.frombuffer(data, '<i4', n, off).astype(np.int32)
+            off += n * 4
+            corners = np.frombuffer(data, '<f4', n * 8, off).astype(np.float32).reshape(-1, 4, 2)
+            info = {}
+            if flags & self.SCORES:
+                info['score'] = np.frombuffer(data, '<f8', n, off + n * 32).tolist()
+            records.append((data[start:start+name_len].decode('utf-8'), index,
+                            ids, corners, info))
+            pos = end
+        self.valid = pos
+        return records
+
+    def open(self):
+        """ open journal for appending, after replay """
+        if self.valid:
+            self.f = open(self.path, 'r+b')
+            # remove partial record
+            self.f.truncate(self.valid)
+            self.f.seek(self.valid)
+        else:
+            self.f = open(self.path, 'wb')
+            self.f.write(self.head)
+
+    def append(self, image_name, index, result):
+        """ write markers found on an image to the journal, data are synced
+            to disk after SYNC_COUNT images or SYNC_TIME seconds
+
+            :param image_name: path to image
+            :param index: index of image in the input images
+            :param result: tuple of marker ids, corners and detection info
+        """
+        ids, corners, info = result
+        name = image_name.encode('utf-8')
+        flags = self.SCORES if 'score' in info else 0
+        rec = self.RECORD.pack(0, len(name), index, ids.size, flags)[4:] + name + \
+              ids.astype('<i4').tobytes() + corners.astype('<f4').tobytes()
+        if flags:
+            rec += np.array(info['score'], '<f8').tobytes()
+        self.f.write(struct.pack('<I', zlib.crc32(rec)) + rec)
+        self.pending += 1
+        if self.pending >= self.SYNC_COUNT or time.time() - self.synced >= self.SYNC_TIME:
+            self.sync()
+
+    def sync(self):
+        """ write journal to disk """
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pending = 0
+        self.synced = time.time()
+
+    def close(self):
+        """ sync and close journal """
+        if self.f is not None:
+            self.sync()
+            self.f.close()
+            self.f = None
+
+class WorkQueue():
+    """ queue of images in an SQLite database on a shared file system,
+        workers on any host claim images in batches for a lease time,
+        images of an expired lease are claimed again by other workers,
+        results are posted back to the database
+    """
+    PENDING, CLAIMED, DONE, ERROR = range(4)    # states of images
+    WAIT = 5.0          # seconds between checks of batches of other workers
+
+    def __init__(self, path, settings):
+        """ Initialize WorkQueue object
+
+            :param path: path to SQLite database file
+            :param settings: detection settings (see MarkerDetector.cache_key) or None to read any queue
+        """
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+        # transactions are handled explicitly, locks are waited for
+        self.con = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.con.execute("""CREATE TABLE IF NOT EXISTS meta (
+                            key TEXT PRIMARY KEY, value TEXT)""")
+        self.con.execute("""CREATE TABLE IF NOT EXISTS images (
+                            idx INTEGER PRIMARY KEY, name TEXT UNIQUE,
+                            state INTEGER, worker TEXT, lease REAL)""")
+        self.con.execute("CREATE INDEX IF NOT EXISTS images_state ON images (state)")
+        self.con.execute("""CREATE TABLE IF NOT EXISTS results (
+                            idx INTEGER PRIMARY KEY, ids BLOB, corners BLOB,
+                            scores BLOB)""")
+        if settings is not None:
+            key_str = json.dumps(settings, sort_keys=True)
+            # dictionaries are necessary to split marker ids at collect
+            meta = {'settings': hashlib.sha256(key_str.encode()).hexdigest(),
+                    'dict': json.dumps(settings['dict'])}
+            self.con.execute("BEGIN IMMEDIATE")
+            self.con.executemany("INSERT OR IGNORE INTO meta VALUES (?, ?)", meta.items())
+            self.con.execute("COMMIT")
+        self.meta = dict(self.con.execute("SELECT key, value FROM meta"))
+        if settings is not None and self.meta['settings'] != meta['settings']:
+            raise ValueError('queue was created with other detection settings')
+
+    def add(self, names):
+        """ add images to the queue, images already in queue are skipped
+
+            :param names: list of image paths
+            :return: number of images added
+        """
+        self.con.execute("BEGIN IMMEDIATE")
+        before = self.con.total_changes
+        self.con.executemany("INSERT OR IGNORE INTO images (name, state) VALUES (?, ?)",
+                             ((name, self.PENDING) for name in names))
+        added = self.con.total_changes - before
+        self.con.execute("COMMIT")
+        return added
+
+    def claim(self, batch, lease):
+        """ claim pending images or images of expired leases
+
+            :param batch: max number of images to claim
+            :param lease: lease time in seconds
+            :return: list of image paths claimed
+        """
+        now = time.time()
+        self.con.execute("BEGIN IMMEDIATE")
+        rows = self.con.execute("""SELECT idx, name FROM images
+                                   WHERE state=? OR (state=? AND lease<?)
+                                   ORDER BY idx LIMIT ?""",
+                                (self.PENDING, self.CLAIMED, now, batch)).fetchall()
+        self.con.executemany("UPDATE images SET state=?, worker=?, lease=? WHERE idx=?",
+                             ((self.CLAIMED, self.worker, now + lease, idx)
+                              for idx, _ in rows))
+        self.con.execute("COMMIT")
+        return [name for _, name in rows]
+
+    def post(self, image_name, result, lease):
+        """ store result of an image and extend lease of the other
+            images claimed by the worker
+
+            :param image_name: path to image
+            :param result: tuple of marker ids, corners and detection info or None for unreadable image
+            :param lease: lease time in seconds
+        """
+        self.con.execute("BEGIN IMMEDIATE")
+        idx = self.con.execute("SELECT idx FROM images WHERE name=?",
+                               (image_name,)).fetchone()[0]
+        if result is None:
+            state = self.ERROR
+        else:
+            state = self.DONE
+            scores = None
+            if 'score' in result[2]:
+                scores = np.array(result[2]['score'], np.float64).tobytes()
+            self.con.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                             (idx, result[0].astype(np.int32).tobytes(),
+                              result[1].astype(np.float32).tobytes(), scores))
+        self.con.execute("UPDATE images SET state=? WHERE idx=?", (state, idx))
+        self.con.execute("UPDATE images SET lease=? WHERE state=? AND worker=?",
+                         (time.time() + lease, self.CLAIMED, self.worker))
+        self.con.execute("COMMIT")
+
+    def unfinished(self):
+        """ number of images not processed yet
+
+            :return: number of pending and claimed images
+        """
+        return self.con.execute("SELECT COUNT(*) FROM images WHERE state<?",
+                                (self.DONE,)).fetchone()[0]
+
+    def results(self):
+        """ read results of images in the order of adding
+
+            :return: generator of (image name, ids, corners, info) tuples, ids is None for unreadable images
+        """
+        for name, ids, corners, scores in self.con.execute(
+                """SELECT name, ids, corners, scores FROM images
+                   LEFT JOIN results USING (idx) ORDER BY idx"""):
+            if ids is None:
+                yield name, None, None, {}
+                continue
+            info = {}
+            if scores is not None:
+                info['score'] = np.frombuffer(scores, np.float64).tolist()
+            yield name, np.frombuffer(ids, np.int32).copy(), \
+                  np.frombuffer(corners, np.float32).reshape(-1, 4, 2).copy(), info
+
+    def close(self):
+        """ close database """
+        self.con.close()
+
+class DetectionStore():
+    """ columnar store of marker observations, image names are interned,
+        arrays are grown in chunks
+    """
+    CHUNK = 4096        # min number of observations added at growing
+
+    def __init__(self, keep_corners=True):
+        """ Initialize DetectionStore object
+
+            :param keep_corners: store corners of markers for the output
+        """
+        self.keep_corners = keep_corners
+        self.names = []         # interned image names
+        self.index = {}         # image name to index in names
+        self.size = 0           # number of observations
+        self.image = np.zeros(0, np.int32)
+        self.ids = np.zeros(0, np.int32)
+        self.dicts = np.zeros(0, np.int32)
+        self.corners = np.zeros((0, 4, 2), np.float32)
+
+    def __len__(self):
+        """ number of observations """
+        return self.size
+
+    def intern(self, image_name):
+        """ get index of an image name, new names are added
+
+            :param image_name: path to image
+            :return: index of image name
+        """
+        if image_name not in self.index:
+            self.index[image_name] = len(self.names)
+            self.names.append(image_name)
+        return self.index[image_name]
+
+    def grow(self, size):
+        """ extend capacity of arrays, the chunk size grows with the store
+
+            :param size: min number of observations to store
+        """
+        capacity = max(size, self.ids.size + max(self.CHUNK, self.ids.size // 2))
+        for name in ('image', 'ids', 'dicts') + (('corners',) if self.keep_corners else ()):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def add(self, image_name, ids, dict_ids, corners):
+        """ add markers of an image
+
+            :param image_name: path to image
+            :param ids: marker ids (n)
+            :param dict_ids: dictionary ids of markers (n)
+            :param corners: marker corners (n x 4 x 2)
+        """
+        n = ids.size
+        if self.size + n > self.ids.size:
+            self.grow(self.size + n)
+        sel = slice(self.size, self.size + n)
+        self.image[sel] = self.intern(image_name)
+        self.ids[sel] = ids
+        self.dicts[sel] = dict_ids
+        if self.keep_corners:
+            self.corners[sel] = corners
+        self.size += n
+
+    def counts(self):
+        """ number of observations of markers
+
+            :return: dictionary of marker id and number of observations
+        """
+        ids, counts = np.unique(self.ids[:self.size], return_counts=True)
+        return dict(zip(ids.tolist(), counts.tolist()))
+
+    def images_by_id(self):
+        """ images of markers in the order of processing
+
+            :return: dictionary of marker id and list of image names
+        """
+        ids = self.ids[:self.size]
+        order = np.argsort(ids, kind='stable')
+        _, starts = np.unique(ids[order], return_index=True)
+        groups = np.split(order, starts[1:])
+        # marker ids in the order of the first observation
+        groups.sort(key=lambda g: g[0])
+        return {ids[g[0]]: [self.names[k] for k in self.image[g]] for g in groups if g.size}
+
+    def rows(self):
+        """ output rows of observations, center and size of markers are
+            calculated for all observations at once
+
+            :return: generator of (x, y, image name, id, size, dictionary id) tuples
+        """
+        basenames = [os.path.basename(name) for name in self.names]
+        corners = self.corners[:self.size]
+        centers = self.centers(corners)
+        sizes = self.sizes(corners)
+        for i in range(self.size):
+            yield (centers[i, 0], centers[i, 1], basenames[self.image[i]],
+                   self.ids[i], sizes[i], self.dicts[i])
+
+    @staticmethod
+    def centers(corners):
+        """ rounded center of markers
+
+            :param corners: marker corners (n x 4 x 2)
+            :return: x, y of centers (n x 2)
+        """
+        return np.rint(corners.mean(axis=1)).astype(np.int32)
+
+    @staticmethod
+    def sizes(corners):
+        """ size of markers for Meshroom, half of the max side or
+            0.707 times the diagonals
+
+            :param corners: marker corners (n x 4 x 2)
+            :return: sizes (n)
+        """
+        if corners.shape[0] == 0:
+            return np.zeros(0, np.float32)
+        sides = norm(corners - np.roll(corners, 1, axis=1), axis=2)
+        diagonals = 0.707 * norm(corners[:, [2, 3]] - corners[:, [0, 1]], axis=2)
+        return 0.5 * np.maximum(sides.max(axis=1), diagonals.max(axis=1))
+
+class CameraModel():
+    """ pinhole camera model of nadir images, position and focal length are
+        taken from EXIF data of images, sensor size from the sensor
+        database of gsd_calc
+    """
+
+    def __init__(self, args):
+        """ Initialize CameraModel object
+
+            :param args: processed command line parameters
+        """
+        self.epsg = args.epsg
+        self.swidth = args.swidth
+        self.focal = args.focal
+        if args.camera is not None:
+            with open(args.sensordb, encoding='ascii') as f:
+                sensors = json.load(f)
+            if args.camera not in sensors:
+                raise ValueError(f'camera {args.camera} not found in {args.sensordb}')
+            if self.swidth is None:
+                self.swidth = sensors[args.camera]['swidth']
+            if self.focal is None:
+                self.focal = sensors[args.camera].get('focal')
+        if self.swidth is None:
+            raise ValueError('sensor width is unknown, use --camera or --swidth')
+        self.transformer = None
+        if args.prefilter or args.roi:
+            # image positions are compared to GCP coordinates
+            if args.epsg is None:
+                raise ValueError('EPSG code of GCP coordinates is necessary, use --epsg')
+            self.transformer = self.make_transformer(args.epsg)
+        elif args.input and args.epsg is not None:
+            # GCP positions are predicted if possible
+            try:
+                self.transformer = self.make_transformer(args.epsg)
+            except ValueError:
+                pass
+
+    @staticmethod
+    def needed(args):
+        """ check if a camera model is necessary for the processing
+
+            :param args: processed command line parameters
+            :return: True if image positions or GSD are used
+        """
+        return bool(args.prefilter or args.roi or
+                    (args.markercm is not None and args.gsd is None))
+
+    @staticmethod
+    def make_transformer(epsg):
+        """ create transformation from WGS84 image positions to GCP coordinates
+
+            :param epsg: EPSG code of GCP coordinates
+            :return: pyproj transformer
+        """
+        try:
+            from pyproj import Transformer
+        except ImportError as e:
+            raise ValueError('pyproj is necessary to transform image positions') from e
+        return Transformer.from_crs(4326, epsg, always_xy=True)
+
+    def __getstate__(self):
+        """ the transformer is not passed to worker processes """
+        state = dict(self.__dict__)
+        state['transformer'] = self.transformer is not None
+        return state
+
+    def __setstate__(self, state):
+        """ the transformer is rebuilt in worker processes """
+        self.__dict__.update(state)
+        self.transformer = self.make_transformer(self.epsg) if self.transformer else None
+
+    def image_pose(self, image_name):
+        """ get position and camera parameters of an image from EXIF data
+
+            :param image_name: path to image
+            :return: dictionary of east, north, altitude (camera position),
+                     focal length (mm), width and height (pixels) of image
+                     or None if EXIF data are not available, east and north
+                     are None if no transformation to GCP coordinates
+        """
+        import exif_pos
+        try:
+            pos = exif_pos.img_pos(image_name)
+            cam = exif_pos.img_camera(image_name)
+        except Exception:
+            return None
+        if len(pos) < 3 or not isinstance(pos[0], float):
+            return None
+        focal = self.focal if self.focal is not None else cam.get('focal')
+        if not focal:
+            return None
+        east = north = None
+        if self.transformer is not None:
+            east, north = self.transformer.transform(pos[0], pos[1])
+        return {'east': east, 'north': north, 'alt': pos[2], 'focal': focal,
+                'width': cam['width'], 'height': cam['height']}
+
+    def gsd(self, pose, height):
+        """ ground sample distance of an image
+
+            :param pose: image position and camera parameters (see image_pose)
+            :param height: height of camera above the ground
+            :return: size of a pixel on the ground in meters
+        """
+        return height * self.swidth / (pose['focal'] * pose['width'])
+
+    def footprint_radius(self, pose, height):
+        """ radius of the circle around the image center containing the
+            ground footprint of the image in any rotation
+
+            :param pose: image position and camera parameters (see image_pose)
+            :param height: height of camera above the ground
+            :return: radius in meters
+        """
+        return self.gsd(pose, height) * math.hypot(pose['width'], pose['height']) / 2
+
+class NullProfiler():
+    """ profiler doing nothing, used when profiling is off """
+
+    enabled = False
+    NULL_STAGE = contextlib.nullcontext()
+
+    def begin(self, image_name):
+        """ dummy function """
+
+    def end(self, image_name):
+        """ dummy function """
+        return None
+
+    def stage(self, name, image_name=None):
+        """ dummy function """
+        return self.NULL_STAGE
+
+    def buffer(self, label, array, image_name=None):
+        """ dummy function """
+
+class Profiler():
+    """ collect wall and CPU time of processing stages and size of image
+        buffers for each image
+    """
+
+    enabled = True
+
+    def __init__(self):
+        """ Initialize Profiler object """
+        self.images = {}        # stage times and buffer sizes by image
+        self.totals = {}        # stages not bound to an image
+        self.current = None     # image under processing
+        self.lock = threading.Lock()
+        self.local = threading.local()  # depth of nested stages in threads
+
+    def record(self, image_name):
+        """ get record of an image, create it if not exists
+
+            :param image_name: path to image
+            :return: dictionary of stage times and buffer sizes
+        """
+        if image_name not in self.images:
+            self.images[image_name] = {'stages': {}, 'buffers': {}, 'spans': []}
+        return self.images[image_name]
+
+    def begin(self, image_name):
+        """ start processing of an image, stages without image name are
+            added to this image
+
+            :param image_name: path to image
+        """
+        self.current = image_name
+
+    def end(self, image_name):
+        """ finish processing of an image and remove its record
+
+            :param image_name: path to image
+            :return: record of image
+        """
+        if self.current == image_name:
+            self.current = None
+        with self.lock:
+            return self.images.pop(image_name, None)
+
+    @contextlib.contextmanager
+    def stage(self, name, image_name=None):
+        """ measure wall and CPU time of a stage, the time spans of
+            outermost stages of threads are kept for the image times
+
+            :param name: name of stage
+            :param image_name: path to image, default the image under processing
+        """
+        if image_name is None:
+            image_name = self.current
+        depth = getattr(self.local, 'depth', 0)
+        self.local.depth = depth + 1
+        wall0 = time.perf_counter()
+        cpu0 = time.process_time()
+        try:
+            yield
+        finally:
+            wall1 = time.perf_counter()
+            cpu1 = time.process_time()
+            self.local.depth = depth
+            with self.lock:
+                if image_name is None:
+                    stages = self.totals
+                else:
+                    rec = self.record(image_name)
+                    stages = rec['stages']
+                    if depth == 0:
+                        rec['spans'].append((wall0, wall1, cpu0, cpu1))
+                if name not in stages:
+                    stages[name] = [0.0, 0.0]
+                stages[name][0] += wall1 - wall0
+                stages[name][1] += cpu1 - cpu0
+
+    def buffer(self, label, array, image_name=None):
+        """ store size of an image buffer
+
+            :param label: name of buffer
+            :param array: numpy array
+            :param image_name: path to image, default the image under processing
+        """
+        if image_name is None:
+            image_name = self.current
+        with self.lock:
+            buffers = self.record(image_name)['buffers']
+            buffers[label] = max(buffers.get(label, 0), array.nbytes)
+
+    def collect(self, image_name, record):
+        """ add record of an image processed by another process
+
+            :param image_name: path to image
+            :param record: record of image from end
+        """
+        with self.lock:
+            rec = self.record(image_name)
+            for name, times in record['stages'].items():
+                act = rec['stages'].setdefault(name, [0.0, 0.0])
+                act[0] += times[0]
+                act[1] += times[1]
+            for label, size in record['buffers'].items():
+                rec['buffers'][label] = max(rec['buffers'].get(label, 0), size)
+            # clocks of other processes are not comparable, spans are not merged
+            rec.setdefault('remote', []).append(record['spans'])
+
+    @staticmethod
+    def span_length(spans):
+        """ length of the union of time spans, overlapping stages of
+            threads are counted once
+
+            :param spans: list of (start, end) tuples
+            :return: total length
+        """
+        total = 0.0
+        last = None
+        for start, end in sorted(spans):
+            if last is None or start > last:
+                total += end - start
+                last = end
+            elif end > last:
+                total += end - last
+                last = end
+        return total
+
+    def image_times(self, rec):
+        """ wall and CPU time of an image from the spans of its stages
+
+            :param rec: record of image
+            :return: tuple of wall and CPU time
+        """
+        groups = [rec['spans']] + rec.get('remote', [])
+        wall = sum(self.span_length([(s[0], s[1]) for s in spans]) for spans in groups)
+        cpu = sum(self.span_length([(s[2], s[3]) for s in spans]) for spans in groups)
+        return wall, cpu
+
+    @staticmethod
+    def stats(values):
+        """ calculate statistics of values
+
+            :param values: list of values
+            :return: dictionary of statistics
+        """
+        return {'total': float(np.sum(values)),
+                'p50': float(np.percentile(values, 50)),
+                'p95': float(np.percentile(values, 95)),
+                'max': float(np.max(values))}
+
+    def write(self, path, slowest=10):
+        """ write profile report to a JSON file
+
+            :param path: path to output file
+            :param slowest: number of slowest images to list
+        """
+        images = []
+        for name, rec in self.images.items():
+            wall, cpu = self.image_times(rec)
+            images.append({'image': name, 'wall': wall, 'cpu': cpu,
+                           'stages': rec['stages'],
+                           'buffers': rec['buffers']})
+        stages = {}
+        for img in images:
+            for name, times in img['stages'].items():
+                stages.setdefault(name, []).append(times)
+        report = {'images': len(images),
+                  'stages': {name: {'count': len(times),
+                                    'wall': self.stats([t[0] for t in times]),
+                                    'cpu': self.stats([t[1] for t in times])}
+                             for name, times in stages.items()},
+                  'totals': self.totals}
+        if images:
+            report['image'] = {'wall': self.stats([img['wall'] for img in images]),
+                               'cpu': self.stats([img['cpu'] for img in images])}
+        try:
+            import resource
+            # kB on Linux
+            report['peak_rss_mb'] = {
+                'main': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                'workers': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+        except ImportError:
+            pass
+        buffers = [{'image': img['image'], 'buffer': label, 'bytes': size}
+                   for img in images for label, size in img['buffers'].items()]
+        report['largest_buffers'] = sorted(buffers, key=lambda b: -b['bytes'])[:slowest]
+        report['slowest'] = sorted(images, key=lambda img: -img['wall'])[:slowest]
+        report['per_image'] = images
+        with open(path, 'w', encoding='ascii') as f:
+            json.dump(report, f, indent=2)
 
+# detector of the actual worker process
+_worker_detector = None
+
+def init_worker(args, par_dict, coords, camera, threads):
+    """ initialize a worker process of the process pool
+
+        :param args: processed command line parameters
+        :param par_dict: aruco find params in a dictionary
+        :param coords: GCP coordinates
+        :param camera: camera model or None
+        :param threads: number of OpenCV threads in the worker
+    """
+    global _worker_detector
+    cv2.setNumThreads(threads)
+    _worker_detector = MarkerDetector(args, dict_to_params(par_dict), coords, camera)
+
+def detect_worker(image_name):
+    """ find markers on an image in a worker process
+
+        :param image_name: path to image to process
+        :return: tuple of image name and detection result
+    """
+    result = _worker_detector.detect_image(image_name)
+    # stage times are sent to the main process
+    record = _worker_detector.profiler.end(image_name)
+    if result is not None and record is not None:
+        result[2]['profile'] = record
+    return image_name, result
+
+def detect_request(item):
+    """ find markers on an image of a server request in a worker process,
+        image data sent are written to a temporary file for the detector,
+        errors are returned to answer the request instead of breaking the
+        connection
+
+        :param item: tuple of image name and image data or None to read image file
+        :return: tuple of image name, detection result and error message or None
+    """
+    image_name, data = item
+    try:
+        if data is None:
+            return detect_worker(image_name) + (None,)
+        with tempfile.NamedTemporaryFile(suffix=os.path.splitext(image_name)[1]) as f:
+            f.write(data)
+            f.flush()
+            result = _worker_detector.detect_image(f.name)
+            _worker_detector.profiler.end(f.name)
+    except Exception as e:
+        return image_name, None, f'{type(e).__name__}: {e}'
+    return image_name, result, None
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """ handle JSON lines requests of a client connection, an answer line
+        is sent for each request line
+    """
+
+    def handle(self):
+        """ answer requests till the client closes the connection """
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                answer = self.server.gcp_find.answer(json.loads(line))
+            except (ValueError, KeyError, TypeError) as e:
+                answer = {'error': f'invalid request: {e}'}
+            self.wfile.write(json.dumps(answer).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+class GcpFind():
+    """ class to collect GCPs on an image """
+
+    # record of an observation in the spill file of stream mode
+    SPILL_DTYPE = np.dtype([('x', '<i4'), ('y', '<i4'), ('image', '<i4'),
+                            ('id', '<i4'), ('dict', '<i4'), ('size', '<f4')])
+
+    def __init__(self, args, params):
+        """ Initialize GcpFind object
+
+            :param args: processed command line parameters
+            :param params: aruco find params
+        """
+        self.args = args
         # set aruco parameters from command line arguments
         self.params = params
         if args.aruco_params is None:
@@ -67,9 +2053,10 @@ class GcpFind():
             self.params.minCornerDistanceRate = args.corner
             self.params.minDistanceToBorder = args.borderdist
             self.params.minMarkerDistanceRate = args.markerdist
-            self.minMarkerLengthRatioOriginalImg = args.lengthratio
+            self.params.minMarkerLengthRatioOriginalImg = args.lengthratio
             self.params.minMarkerPerimeterRate = args.minrate
             self.params.minOtsuStdDev = args.otsu
+            self.params.minSideLengthCanonicalImg = args.minside
             self.params.perspectiveRemoveIgnoredMarginPerCell = args.ignore
             self.params.perspectiveRemovePixelPerCell = args.persp
             self.params.polygonalApproxAccuracyRate = args.poly
@@ -81,20 +2068,20 @@ class GcpFind():
             js = json.loads(data)
             for par in js:
                 setattr(self.params, par, js[par])
+        if args.fast:
+            # ArUco3 detection on downsampled image, the downsampling
+            # ratio is set for each image size by the marker detector
+            self.params.useAruco3Detection = True
         if args.list:
             # list available aruco dictionary names & exit
             for act_dict in self.list_dicts():
                 print(f'{act_dict[0]} : {act_dict[1]}', file=sys.stderr)
             # list all aruco parameters
-            for par in dir(self.params):
-                if not par.startswith('__'):
-                    val = getattr(self.params, par)
-                    if type(val) in (int, float, str, bool):
-                        print(f'{par} : {val}', file=sys.stderr)
+            for par, val in params_to_dict(self.params).items():
+                print(f'{par} : {val}', file=sys.stderr)
             sys.exit(0)
 
         self.coords = {}
-        self.gcp_found = {}          # initialize gcp to image dict
         if not self.check_params():
             sys.exit(1)
 
@@ -102,10 +2089,68 @@ class GcpFind():
             # load GCP coords
             self.coo_input()
 
-        # lookup table for color correction
-        self.lut = np.interp(np.arange(0, 256), self.LUT_IN,
-                             self.LUT_OUT).astype(np.uint8)
-        self.gcps = []  # list for found gcps
+        self.camera = None
+        if CameraModel.needed(args):
+            try:
+                self.camera = CameraModel(args)
+            except (ValueError, OSError) as e:
+                print(f'cannot set up camera model: {e}', file=sys.stderr)
+                sys.exit(1)
+
+        try:
+            self.detector = MarkerDetector(args, self.params, self.coords, self.camera)
+        except (OSError, ValueError, AttributeError) as e:
+            print(f'cannot set up marker detector: {e}', file=sys.stderr)
+            sys.exit(1)
+        if self.detector.id_map is not None:
+            self.subdict_stats()
+        self.profiler = self.detector.profiler
+        self.offsets = []   # predicted - found offsets of GCPs in roi mode
+        self.passes_won = {}    # number of images by escalation pass
+        self.qualities = {}     # number of images by quality level
+        self.imagelog = None
+        if args.imagelog:
+            try:
+                self.imagelog = open(args.imagelog, 'w', encoding='ascii')
+            except OSError:
+                print('cannot open image log file', file=sys.stderr)
+                sys.exit(1)
+        self.cache = None
+        # results of workers are shared by the queue, the cache file would
+        # be locked by workers on the shared file system
+        if not args.no_cache and not args.debug and not args.serve and not args.worker:
+            try:
+                self.cache = DetectionCache(args.cache, args.cachesize * 1e6,
+                                            args.cachehash)
+            except sqlite3.Error as e:
+                print(f'cannot open cache {args.cache}: {e}', file=sys.stderr)
+        # markers found, corners are necessary if output is written at the end
+        self.store = DetectionStore(not (args.stream or args.best))
+        self.foutput = None     # output file in stream mode
+        self.spill = None       # temporary file of observations in stream mode
+        self.output_tmp = None  # temporary output file renamed at the end
+        self.pool = None        # worker processes in server and worker mode
+        self.journal = None
+        if args.journal or args.shard:
+            # partial result of a shard is written as a journal
+            self.journal = DetectionJournal(args.output if args.shard else args.journal,
+                                            self.detector.cache_key())
+        self.queue = None
+        if args.queue:
+            try:
+                self.queue = WorkQueue(args.queue, self.detector.cache_key()
+                                       if args.worker else None)
+            except (sqlite3.Error, ValueError) as e:
+                print(f'cannot use queue {args.queue}: {e}', file=sys.stderr)
+                sys.exit(1)
+        # index of images in input, it gives the order of merged results
+        self.name_index = {}
+        for i, name in enumerate(args.names):
+            self.name_index.setdefault(name, i)
+        self.best = {}          # heaps of best observations by GCP id
+        self.seq = 0            # number of observations
+        self.id_counts = {}     # observations by GCP id in best and stream mode
+        self.id_dicts = {}      # source dictionary by GCP id, None after warning
 
     @staticmethod
     def list_dicts():
@@ -124,7 +2169,28 @@ class GcpFind():
 
             :return: False in case of parameter error
         """
-        if not self.args.names:
+        if self.args.queue:
+            if self.args.worker == self.args.collect:
+                print("either worker or collect is necessary for queue", file=sys.stderr)
+                return False
+            if self.args.journal or self.args.shard or self.args.merge or self.args.debug:
+                print("queue cannot be used together with journal, shard, merge or debug", file=sys.stderr)
+                return False
+            if self.args.worker and self.args.stream:
+                print("worker cannot be used together with stream", file=sys.stderr)
+                return False
+            if self.args.batch < 1 or self.args.lease <= 0:
+                print("batch and lease must be positive", file=sys.stderr)
+                return False
+        elif self.args.worker or self.args.collect:
+            print("queue is necessary for worker and collect", file=sys.stderr)
+            return False
+        if self.args.serve:
+            if self.args.journal or self.args.shard or self.args.merge or \
+               self.args.queue or self.args.debug or self.args.stream or self.args.best:
+                print("serve cannot be used together with journal, shard, merge, queue, debug, stream or best", file=sys.stderr)
+                return False
+        elif not self.args.names and not self.args.queue:
             print("no input images given", file=sys.stderr)
             return False
         if self.args.input:
@@ -132,8 +2198,67 @@ class GcpFind():
                not os.access(self.args.input, os.R_OK):
                 print(f'cannot open input file {self.args.input}', file=sys.stderr)
                 return False
+        elif self.args.prefilter or self.args.roi:
+            print("input GCP coordinates are necessary for prefilter and roi", file=sys.stderr)
+            return False
+        if self.args.ids:
+            try:
+                parse_ids(self.args.ids)
+            except ValueError:
+                print(f'invalid marker ids: {self.args.ids}', file=sys.stderr)
+                return False
+        elif self.args.subdict and not self.args.input:
+            print("marker ids (ids or input) are necessary for subdict", file=sys.stderr)
+            return False
+        if (self.args.journal or self.args.shard) and self.args.debug:
+            print("journal and shard cannot be used in debug mode", file=sys.stderr)
+            return False
+        if self.args.shard:
+            if self.args.output == sys.stdout:
+                print("output file is necessary for shard", file=sys.stderr)
+                return False
+            if self.args.journal or self.args.merge or self.args.stream:
+                print("shard cannot be used together with journal, merge or stream", file=sys.stderr)
+                return False
+        if self.args.best is not None:
+            if self.args.best < 1:
+                print("best must be positive", file=sys.stderr)
+                return False
+            if self.args.limit is not None:
+                print("best and limit cannot be used together", file=sys.stderr)
+                return False
+        if self.args.deadline_ms is not None:
+            if self.args.deadline_ms <= 0:
+                print("deadline must be positive", file=sys.stderr)
+                return False
+            if self.args.decode == 'reduced':
+                print("deadline cannot be used with reduced decode", file=sys.stderr)
+                return False
         return True
 
+    def subdict_stats(self):
+        """ print minimal Hamming distance of the reduced dictionaries and
+            the error correction rate which can be used safely
+        """
+        n = self.detector.id_map.size
+        rates = []
+        for dict_id, aruco_dict in zip(self.args.dict, self.detector.aruco_dicts):
+            dist = min_distance(aruco_dict.bytesList, aruco_dict.markerSize)
+            print(f'reduced dictionary {dict_id} of {n} markers, min Hamming distance: {dist}',
+                  file=sys.stderr)
+            # markers can be identified unambiguously up to this number of bit errors
+            safe_bits = (dist - 1) // 2
+            max_bits = aruco_dict.maxCorrectionBits
+            if max_bits == 0:
+                if safe_bits > 0:
+                    print(f'{safe_bits} bits could be corrected safely, but dictionary {dict_id} has no error correction', file=sys.stderr)
+                continue
+            # rates above 1.0 are not supported by OpenCV
+            rates.append(min(1.0, math.floor(safe_bits / max_bits * 100) / 100))
+        # the rate is common for all dictionaries
+        if rates and min(rates) > self.params.errorCorrectionRate:
+            print(f'errorCorrectionRate {min(rates)} (correctionrate) can be used safely', file=sys.stderr)
+
     def coo_input(self):
         """ load world coordinates of GCPs
             input file format: point_id easting northing elevation
@@ -141,7 +2266,7 @@ class GcpFind():
         """
         with open(self.args.input, 'r', encoding="ascii") as finput:
             for line in finput:
-                co_list = line.strip().split(args.separator)
+                co_list = line.strip().split(self.args.separator)
                 if len(co_list) < 4:
                     print(f"Illegal input: {line}", file=sys.stderr)
                     continue
@@ -155,150 +2280,814 @@ class GcpFind():
 
     def process_images(self):
         """ process all images """
-        # process image files from command line
-        for f_name in self.args.names:
-            # read actual image file
+        t_start = time.perf_counter()
+        names = self.args.names
+        if self.args.stream:
+            self.foutput = self.open_output()
+            if self.foutput is None:
+                sys.exit(1)
+            if self.args.limit is not None:
+                # observations are kept till the final counts are known
+                self.spill = tempfile.TemporaryFile()
+        if self.args.merge:
+            # names are partial results of shards
+            self.merge_shards(names)
+            names = []
+        elif self.args.collect:
+            self.collect()
+            names = []
+        elif self.args.shard:
+            names = self.shard(names)
+        if self.args.prefilter:
+            names = self.prefilter(names)
+        if self.args.worker:
+            added = self.queue.add(names)
             if self.args.verbose:
-                print(f"processing {f_name}", file=sys.stderr)
-            self.process_image(f_name)
-        if self.args.verbose:
-            for j, k in self.gcp_found.items():
+                print(f'{added} images added to queue {self.args.queue}', file=sys.stderr)
+        if self.journal is not None:
+            try:
+                records = self.journal.replay()
+                self.journal.open()
+            except (OSError, ValueError, UnicodeDecodeError) as e:
+                print(f'cannot use journal {self.journal.path}: {e}', file=sys.stderr)
+                sys.exit(1)
+            names = self.resume(names, records)
+        if self.args.debug:
+            # markers are shown on images one by one
+            for f_name, frame, elapsed in self.read_images(names):
+                if self.args.verbose:
+                    print(f"processing {f_name}", file=sys.stderr)
+                self.process_image(f_name, frame, time.perf_counter() - elapsed)
+        elif self.args.worker:
+            self.work()
+        else:
+            for f_name, res in self.detect_images(names):
+                if self.args.verbose:
+                    print(f"processing {f_name}", file=sys.stderr)
+                if self.journal is not None and res is not None:
+                    self.journal.append(f_name, self.name_index[f_name], res)
+                self.add_result(f_name, res)
+        if self.journal is not None:
+            self.journal.close()
+        if self.queue is not None:
+            self.queue.close()
+        if self.cache is not None:
+            self.cache.close()
+        if self.args.roi:
+            self.offset_stats()
+        if self.args.escalate:
+            passes = ', '.join(f'pass {k}: {n}' for k, n in sorted(self.passes_won.items()))
+            print(f'images by escalation pass: {passes}', file=sys.stderr)
+        if self.args.deadline_ms:
+            levels = ', '.join(f'level {k}: {n}' for k, n in sorted(self.qualities.items()))
+            rate = len(names) / (time.perf_counter() - t_start)
+            print(f'images by quality level: {levels}, {rate:.2f} images/s', file=sys.stderr)
+        if self.imagelog is not None:
+            self.imagelog.close()
+        if self.args.verbose and (self.args.best or self.args.stream):
+            for j, n in self.id_counts.items():
+                print(f'GCP{j}: on {n} images', file=sys.stderr)
+        elif self.args.verbose:
+            for j, k in self.store.images_by_id().items():
                 print(f'GCP{j}: on {len(k)} images {k}', file=sys.stderr)
-        self.gcp_output()
+        self.profiler.begin(None)   # output is not bound to an image
+        if not self.args.shard and not self.args.worker:
+            # partial result of a shard is the journal, results of workers are in the queue
+            with self.profiler.stage('output'):
+                self.gcp_output()
+        if self.args.profile:
+            try:
+                self.profiler.write(self.args.profile)
+            except OSError:
+                print('cannot write profile file', file=sys.stderr)
+
+    def resume(self, names, records):
+        """ add markers of images processed by an interrupted run
+
+            :param names: list of image paths
+            :param records: list of (image name, ids, corners, info) from journal
+            :return: list of image paths not processed yet
+        """
+        wanted = set(os.path.normpath(name) for name in names)
+        done = set()
+        for image_name, _, ids, corners, info in records:
+            key = os.path.normpath(image_name)
+            if key in wanted and key not in done:
+                done.add(key)
+                if ids.size:
+                    self.add_markers(image_name, ids, corners, info)
+        if records:
+            print(f'{len(done)} images replayed from journal {self.journal.path}', file=sys.stderr)
+        return [name for name in names if os.path.normpath(name) not in done]
 
-    def process_image(self, image_name):
+    def shard(self, names):
+        """ select images of a shard, images are distributed among shards
+            by file size, larger images first to the shard with the smallest
+            total size
+
+            :param names: list of image paths
+            :return: list of image paths of the shard in input order
+        """
+        k, n = self.args.shard
+        sizes = []
+        for name in names:
+            try:
+                sizes.append(os.path.getsize(name))
+            except OSError:
+                sizes.append(0)
+        loads = [0] * n
+        selected = []
+        for i in sorted(range(len(names)), key=lambda i: (-sizes[i], names[i])):
+            act = min(range(n), key=lambda j: (loads[j], j))
+            loads[act] += sizes[i]
+            if act == k - 1:
+                selected.append(i)
+        selected.sort()
+        if self.args.verbose:
+            print(f'shard {k}/{n}: {len(selected)} images, {loads[k-1] / 1e6:.1f} MB', file=sys.stderr)
+        return [names[i] for i in selected]
+
+    def work(self):
+        """ process images of the queue in batches till all images are
+            processed, batches of other workers are waited for as their
+            lease may expire, the next batch is claimed while the worker
+            processes are busy with the previous one
+        """
+        jobs = max(1, self.args.jobs)
+        if jobs > 1:
+            # pool and detectors are created once for all batches
+            self.pool = self.make_pool(jobs)
+        pending = collections.deque()   # image names and results of the pool
+        try:
+            while True:
+                if len(pending) < jobs:
+                    batch = self.queue.claim(self.args.batch, self.args.lease)
+                    if batch and self.pool is None:
+                        for f_name, res in self.detect_images(batch):
+                            self.post_result(f_name, res)
+                        continue
+                    if batch:
+                        pending.extend((f_name, self.pool.apply_async(detect_worker, (f_name,)))
+                                       for f_name in batch)
+                        continue
+                if pending:
+                    f_name, async_res = pending.popleft()
+                    self.post_result(f_name, async_res.get()[1])
+                    continue
+                if not self.queue.unfinished():
+                    break
+                time.sleep(min(self.queue.WAIT, self.args.lease))
+        finally:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+
+    def post_result(self, image_name, result):
+        """ post result of an image to the queue and add its markers
+
+            :param image_name: path to image
+            :param result: detection result or None if image cannot be read
+        """
+        if self.args.verbose:
+            print(f"processing {image_name}", file=sys.stderr)
+        self.queue.post(image_name, result, self.args.lease)
+        self.add_result(image_name, result)
+
+    def collect(self):
+        """ add markers from the queue in the order of adding images """
+        unfinished = self.queue.unfinished()
+        if unfinished:
+            print(f'{unfinished} images of queue {self.args.queue} are not processed yet', file=sys.stderr)
+            sys.exit(1)
+        if 'dict' not in self.queue.meta:
+            print(f'no images in queue {self.args.queue}', file=sys.stderr)
+            sys.exit(1)
+        # marker ids are split by the dictionaries of workers
+        self.args.dict = json.loads(self.queue.meta['dict'])
+        n = 0
+        for image_name, ids, corners, info in self.queue.results():
+            n += 1
+            if ids is None:
+                print(f'error reading image: {image_name}', file=sys.stderr)
+                continue
+            if self.args.best and 'score' not in info:
+                print('no marker scores in queue, use best for workers too', file=sys.stderr)
+                sys.exit(1)
+            if ids.size:
+                self.add_markers(image_name, ids, corners, info)
+        if self.args.verbose:
+            print(f'{n} images collected from queue {self.args.queue}', file=sys.stderr)
+
+    def merge_shards(self, paths):
+        """ add markers from partial results of shards in the order of
+            the input images of the shards
+
+            :param paths: list of partial result files
+        """
+        records = []
+        digest = None
+        for path in paths:
+            part = DetectionJournal(path, None)
+            try:
+                part_records = part.replay()
+            except (OSError, ValueError, UnicodeDecodeError) as e:
+                print(f'cannot read partial result {path}: {e}', file=sys.stderr)
+                sys.exit(1)
+            if part.digest is None:
+                continue    # empty file
+            if digest is not None and part.digest != digest:
+                print(f'partial result {path} was made with other detection settings', file=sys.stderr)
+                sys.exit(1)
+            digest = part.digest
+            # marker ids are split by the dictionaries of shards
+            self.args.dict = part.meta['dict']
+            records += part_records
+        records.sort(key=lambda rec: rec[1])
+        done = set()
+        for image_name, _, ids, corners, info in records:
+            if image_name not in done:
+                done.add(image_name)
+                if self.args.best and 'score' not in info:
+                    print('no marker scores in partial results, use best for shards too', file=sys.stderr)
+                    sys.exit(1)
+                if ids.size:
+                    self.add_markers(image_name, ids, corners, info)
+        if self.args.verbose:
+            print(f'{len(done)} images merged from {len(paths)} partial results', file=sys.stderr)
+
+    def offset_stats(self):
+        """ print statistics of offsets between predicted and found GCP
+            positions to tune roi window size
+        """
+        if not self.offsets:
+            print('no GCP found at predicted positions', file=sys.stderr)
+            return
+        dist = np.array([math.hypot(dx, dy) for _, dx, dy in self.offsets])
+        print(f'predicted GCP positions: {dist.size} found, offset mean: '
+              f'{np.mean(dist):.1f} median: {np.median(dist):.1f} '
+              f'max: {np.max(dist):.1f} pixels', file=sys.stderr)
+
+    def prefilter(self, names):
+        """ drop images whose ground footprint cannot contain any GCP,
+            images without EXIF position are kept
+
+            :param names: list of image paths
+            :return: list of image paths to process
+        """
+        kept = []
+        for f_name in names:
+            pose = self.camera.image_pose(f_name)
+            if pose is None:
+                if self.args.verbose:
+                    print(f'no EXIF position on image {f_name}', file=sys.stderr)
+                kept.append(f_name)
+            elif self.gcp_on_image(pose):
+                kept.append(f_name)
+            else:
+                print(f'no GCP on the footprint of image {f_name}, skipped', file=sys.stderr)
+        if self.args.verbose:
+            print(f'{len(names) - len(kept)} images skipped by prefilter', file=sys.stderr)
+        return kept
+
+    def gcp_on_image(self, pose):
+        """ check whether any GCP can be on the ground footprint of an image
+
+            :param pose: image position and camera parameters (see CameraModel.image_pose)
+            :return: True if a GCP is inside the footprint extended by the margin
+        """
+        for coo in self.coords.values():
+            if self.args.height is not None:
+                height = self.args.height
+            else:
+                height = pose['alt'] - float(coo[2])
+            if height <= 0:
+                return True     # GCP elevation not consistent with image
+            dist = math.hypot(float(coo[0]) - pose['east'], float(coo[1]) - pose['north'])
+            if dist <= self.camera.footprint_radius(pose, height) + self.args.margin:
+                return True
+        return False
+
+    def read_images(self, names):
+        """ read images, images are read ahead in background if prefetch set
+
+            :param names: list of image paths
+            :return: generator of (image name, image, read time in seconds) tuples
+        """
+        if self.args.prefetch > 0:
+            # images are read in background while processing previous one
+            yield from ImagePrefetcher(names, self.detector.read_image,
+                                       self.args.prefetch, self.args.readers,
+                                       self.args.maxmpix)
+        else:
+            for f_name in names:
+                t1 = time.perf_counter()
+                frame = self.detector.read_image(f_name)
+                yield f_name, frame, time.perf_counter() - t1
+
+    def detect_images(self, names):
+        """ find markers on images using cached results if available
+
+            :param names: list of image paths
+            :return: generator of (image name, detection result) tuples in the order of names
+        """
+        if self.cache is None:
+            yield from self.find_markers(names)
+            return
+        settings = self.detector.cache_key()
+        keys = [self.cache.image_key(f_name, settings) for f_name in names]
+        results = [self.cache.get(key) for key in keys]
+        found = self.find_markers([f_name for f_name, res in zip(names, results)
+                                   if res is None])
+        for f_name, key, res in zip(names, keys, results):
+            if res is None:
+                _, res = next(found)
+                # results degraded by the deadline are not cached
+                if res is not None and \
+                   res[2].get('quality', 0) >= len(self.detector.levels):
+                    self.cache.put(key, res)
+            else:
+                res[2]['cached'] = True
+            yield f_name, res
+
+    def find_markers(self, names):
+        """ find markers on images in parallel processes or in this process
+
+            :param names: list of image paths
+            :return: generator of (image name, detection result) tuples in the order of names
+        """
+        jobs = min(self.args.jobs, len(names))
+        if jobs > 1:
+            yield from self.find_parallel(names, jobs)
+        else:
+            for f_name, frame, elapsed in self.read_images(names):
+                if frame is None:
+                    yield f_name, None
+                else:
+                    # reading is part of the time budget as in worker processes
+                    start = time.perf_counter() - elapsed
+                    self.profiler.begin(f_name)
+                    yield f_name, self.detector.detect(self.detector.gray_image(frame),
+                                                       f_name, start)
+
+    def find_parallel(self, names, jobs):
+        """ find markers on images in a pool of worker processes,
+            results are collected in the order of input images
+
+            :param names: list of image paths
+            :param jobs: number of worker processes
+            :return: generator of (image name, detection result) tuples
+        """
+        with self.make_pool(jobs) as pool:
+            yield from pool.imap(detect_worker, names)
+
+    def make_pool(self, jobs):
+        """ create a pool of worker processes with detectors
+
+            :param jobs: number of worker processes
+            :return: process pool
+        """
+        # output file object cannot be passed to workers
+        worker_args = argparse.Namespace(**vars(self.args))
+        worker_args.output = None
+        threads = max(1, cpu_count() // jobs)
+        return multiprocessing.Pool(jobs, init_worker,
+                                    (worker_args, params_to_dict(self.params),
+                                     self.coords, self.camera, threads))
+
+    def serve(self):
+        """ answer requests of clients on a Unix domain socket or TCP port
+            till interrupted, detectors are kept in worker processes
+        """
+        family, address = self.args.serve
+        if family == socket.AF_UNIX:
+            if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+                # socket file of a previous server
+                os.remove(address)
+            server_class = socketserver.ThreadingUnixStreamServer
+        else:
+            server_class = socketserver.ThreadingTCPServer
+        # workers are started before the socket is opened
+        self.pool = self.make_pool(max(1, self.args.jobs))
+        server = server_class(address, RequestHandler, bind_and_activate=False)
+        server.allow_reuse_address = True
+        server.daemon_threads = True
+        server.gcp_find = self
+        try:
+            server.server_bind()
+            server.server_activate()
+        except OSError as e:
+            print(f'cannot listen on {address}: {e}', file=sys.stderr)
+            self.pool.terminate()
+            sys.exit(1)
+        with self.pool:
+            print(f'listening on {address}', file=sys.stderr)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+                if family == socket.AF_UNIX:
+                    os.remove(address)
+
+    def answer(self, request):
+        """ answer a server request, markers found on an image or output
+            lines of images
+
+            :param request: dictionary of image (path) or name and data (base64) or images (list of paths or name and data dictionaries)
+            :return: dictionary of answer
+        """
+        if isinstance(request, dict) and 'images' in request:
+            if not isinstance(request['images'], list):
+                raise TypeError('images must be a list')
+            items = [self.request_item(req) for req in request['images']]
+            return self.output_answer(self.pool.map(detect_request, items))
+        image_name, result, error = self.pool.apply(detect_request, (self.request_item(request),))
+        if error is not None:
+            return {'image': image_name, 'error': f'detection failed: {error}'}
+        if result is None:
+            return {'image': image_name, 'error': 'cannot read image'}
+        ids, corners, info = result
+        info.pop('profile', None)
+        dict_ids, ids = self.detector.dict_tag(ids)
+        answer = {'image': image_name, 'ids': ids.tolist(), 'corners': corners.tolist(),
+                  'info': info}
+        if len(self.args.dict) > 1:
+            answer['dicts'] = dict_ids.tolist()
+        return answer
+
+    @staticmethod
+    def request_item(request):
+        """ get image of a request
+
+            :param request: path or dictionary of image (path) or name and data (base64)
+            :return: tuple of image name and image data or None to read image file
+        """
+        if isinstance(request, str):
+            return request, None
+        if not isinstance(request, dict):
+            raise TypeError('image must be a path or a dictionary')
+        key = 'name' if 'data' in request else 'image'
+        if not isinstance(request[key], str):
+            raise TypeError(f'{key} must be a string')
+        if key == 'name':
+            return request['name'], base64.b64decode(request['data'])
+        return request['image'], None
+
+    def output_answer(self, results):
+        """ create output of images by the output parameters of the server
+
+            :param results: list of (image name, detection result, error message) tuples
+            :return: dictionary of output text and messages
+        """
+        store = DetectionStore()
+        id_dicts = {}
+        ferr = io.StringIO()
+        for image_name, result, error in results:
+            if error is not None:
+                print(f'detection failed on image {image_name}: {error}', file=ferr)
+                continue
+            if result is None:
+                print(f'error reading image: {image_name}', file=ferr)
+                continue
+            ids = result[0]
+            if ids.size == 0:
+                print(f'No markers found on image {image_name}', file=ferr)
+                continue
+            if len(ids) - len(set(ids.tolist())):
+                print(f'duplicate markers on image {image_name}\nmarker ids: {sorted(ids % self.detector.DICT_STRIDE)}', file=ferr)
+            dict_ids, ids = self.detector.dict_tag(ids)
+            self.check_dicts(ids, dict_ids, id_dicts, ferr)
+            store.add(image_name, ids, dict_ids, result[1])
+        foutput = io.StringIO()
+        self.write_header(foutput)
+        counts = store.counts() if self.args.limit is not None else None
+        for gcp in store.rows():
+            self.write_gcp(foutput, gcp, counts, ferr)
+        return {'output': foutput.getvalue(), 'messages': ferr.getvalue().splitlines()}
+
+    def process_image(self, image_name, frame=None, start=None):
         """ proces single image
 
             :param image_name: path to image to process
+            :param frame: image already read or None to read it
+            :param start: start time of reading the image (perf_counter) in deadline mode, default now
         """
-        frame = cv2.imread(image_name)
+        if start is None:
+            start = time.perf_counter()
+        if frame is None:
+            frame = self.detector.read_image(image_name)
         if frame is None:
+            self.add_result(image_name, None)
+            return
+        self.profiler.begin(image_name)
+        gray = self.detector.gray_image(frame)
+        ids, corners, info = self.detector.detect(gray, image_name, start)
+        self.add_result(image_name, (ids, corners, info))
+        if self.args.debug and ids.size:  # show found ids in debug mode
+            self.show_markers(image_name, frame, gray, ids, corners)
+
+    def add_result(self, image_name, result):
+        """ store markers found on an image
+
+            :param image_name: path to processed image
+            :param result: tuple of marker ids, corners and detection info or None for unreadable image
+        """
+        if result is None:
             print(f'error reading image: {image_name}', file=sys.stderr)
+            self.log_image(image_name, None, {'error': 'cannot read image'})
             return
-        # convert image to gray
-        if self.args.adjust:
-            # adjust colors for better recognition
-            tmp = cv2.LUT(frame, self.lut)
-            gray = cv2.cvtColor(tmp, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        # find markers
-        if packaging.version.parse(cv2.__version__) < packaging.version.parse('4.8'):
-            corners, ids, _ = aruco.detectMarkers(gray,
-                                                  self.aruco_dict,
-                                                  parameters=self.params)
-        else:
-            detector = aruco.ArucoDetector(self.aruco_dict, self.params)
-            corners, ids, _ = detector.detectMarkers(gray)
-        if ids is None:
+        ids, corners, info = result
+        if 'profile' in info:
+            self.profiler.collect(image_name, info.pop('profile'))
+        self.log_image(image_name, ids, info)
+        if 'pass' in info:
+            self.passes_won[info['pass']] = self.passes_won.get(info['pass'], 0) + 1
+            if info['pass'] and self.args.verbose:
+                print(f'  escalated to pass {info["pass"]}', file=sys.stderr)
+        if 'quality' in info:
+            self.qualities[info['quality']] = self.qualities.get(info['quality'], 0) + 1
+            if self.args.verbose:
+                print(f'  quality level {info["quality"]} reached', file=sys.stderr)
+        if 'offsets' in info:
+            self.offsets += info['offsets']
+            if self.args.verbose:
+                for j, dx, dy in info['offsets']:
+                    print(f'  GCP{j} found {dx:.1f} {dy:.1f} pixels from predicted position', file=sys.stderr)
+        if info.get('marker_px') is not None and self.args.verbose:
+            print(f'  expected marker size {info["marker_px"]:.1f} pixels', file=sys.stderr)
+        if 'missing' in info:
+            print(f'GCP {info["missing"]} not found at predicted position, whole image searched {image_name}', file=sys.stderr)
+        if ids.size == 0:
             print(f'No markers found on image {image_name}', file=sys.stderr)
             return
         # check duplicate ids
-        idsl = [pid[0] for pid in ids]
-        if len(ids) - len(set(idsl)):
-            print(f'duplicate markers on image {image_name}\nmarker ids: {sorted(idsl)}', file=sys.stderr)
-        # calculate center & output found markers
+        if len(ids) - len(set(ids.tolist())):
+            print(f'duplicate markers on image {image_name}\nmarker ids: {sorted(ids % self.detector.DICT_STRIDE)}', file=sys.stderr)
         if self.args.verbose:
             print(f'  {ids.size} GCP markers found', file=sys.stderr)
-        if self.args.debug:  # show found ids in debug mode
-            plt.figure()
-            plt.title(f"{len(ids)} GCP, {len(ids) - len(set(idsl))} duplicate found on {image_name}")
-            # show markers on original image
-            aruco.drawDetectedMarkers(gray, corners, ids)
-            plt.imshow(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        with self.profiler.stage('center', image_name):
+            self.add_markers(image_name, ids, corners, info)
+
+    def add_markers(self, image_name, ids, corners, info):
+        """ store markers of an image for the output
+
+            :param image_name: path to processed image
+            :param ids: marker ids, shifted by dictionary index (n)
+            :param corners: marker corners (n x 4 x 2)
+            :param info: dictionary of detection info
+        """
+        dict_ids, ids = self.detector.dict_tag(ids)
+        self.check_dicts(ids, dict_ids, self.id_dicts)
+        if self.args.best or self.args.stream:
+            # observations are not kept, only counted for limit and verbose
+            if self.args.limit is not None or self.args.verbose:
+                for j in ids.tolist():
+                    self.id_counts[j] = self.id_counts.get(j, 0) + 1
+        else:
+            self.store.add(image_name, ids, dict_ids, corners)
+        if self.args.stream or self.args.best:
+            self.store_image(image_name, ids, dict_ids, corners, info.get('score'))
+
+    def check_dicts(self, ids, dict_ids, seen, ferr=None):
+        """ warn once if a marker id is found in several dictionaries,
+            GCP coordinates are matched by marker id only
+
+            :param ids: marker ids in the dictionary (n)
+            :param dict_ids: dictionary ids of markers (n)
+            :param seen: dictionary of marker id and source dictionary id
+            :param ferr: file object for messages, default stderr
+        """
+        if len(self.args.dict) < 2:
+            return
+        if ferr is None:
+            ferr = sys.stderr
+        for j, d in zip(ids.tolist(), dict_ids.tolist()):
+            first = seen.setdefault(j, d)
+            if first is not None and first != d:
+                print(f'marker {j} found in dictionaries {first} and {d}', file=ferr)
+                seen[j] = None
+
+    def log_image(self, image_name, ids, info):
+        """ write detection info of an image to the image log
+
+            :param image_name: path to processed image
+            :param ids: marker ids found or None
+            :param info: dictionary of detection info
+        """
+        if self.imagelog is None:
+            return
+        rec = {'image': image_name}
+        if ids is not None:
+            dict_ids, ids = self.detector.dict_tag(ids)
+            rec['markers'] = int(ids.size)
+            rec['ids'] = [int(j) for j in ids]
+            if len(self.args.dict) > 1:
+                rec['dicts'] = [int(d) for d in dict_ids]
+        for key, val in info.items():
+            if key == 'offsets':
+                continue
+            rec[key] = val
+        self.imagelog.write(json.dumps(rec) + '\n')
+
+    def show_markers(self, image_name, frame, gray, ids, corners):
+        """ show found markers on image in debug mode
+
+            :param image_name: path to processed image
+            :param frame: color image
+            :param gray: gray image used for detection
+            :param ids: marker ids found
+            :param corners: marker corners found
+        """
+        # matplotlib is imported only in debug mode, it is slow to import
+        import matplotlib.pyplot as plt
+        _, ids = self.detector.dict_tag(ids)
+        idsl = list(ids)
+        plt.figure()
+        plt.title(f"{len(ids)} GCP, {len(ids) - len(set(idsl))} duplicate found on {image_name}")
+        # show markers on original image
+        aruco.drawDetectedMarkers(gray, corners.reshape(-1, 1, 4, 2), ids.reshape(-1, 1))
+        plt.imshow(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        for i in range(ids.size):
+            j = ids[i]
+            x = int(round(np.average(corners[i][:, 0])))
+            y = int(round(np.average(corners[i][:, 1])))
+            if j in self.coords:
+                plt.plot(x, y, self.args.markerstyle, markersize=self.args.markersize,
+                         markeredgecolor=self.args.edgecolor, markeredgewidth=self.args.edgewidth)
+            else:
+                plt.plot(x, y, self.args.markerstyle1, markersize=self.args.markersize,
+                         markeredgecolor=self.args.edgecolor, markeredgewidth=self.args.edgewidth)
+            plt.text(x+self.args.markersize, y, str(j),
+                     color=self.args.fontcolor1, weight=self.args.fontweight1, fontsize=self.args.fontsize)
+            plt.text(x+self.args.markersize, y, str(j),
+                     color=self.args.fontcolor, weight=self.args.fontweight, fontsize=self.args.fontsize)
+        #plt.legend()
+        plt.show()
+
+    def store_image(self, image_name, ids, dict_ids, corners, scores):
+        """ store observations of an image in best mode and stream mode,
+            the best observations of GCPs are kept only in best mode, in
+            stream mode they are written to the output if there is no limit
+            or to the spill file
+
+            :param image_name: path to image
+            :param ids: marker ids (n)
+            :param dict_ids: dictionary ids of markers (n)
+            :param corners: marker corners (n x 4 x 2)
+            :param scores: list of quality scores or None
+        """
+        centers = DetectionStore.centers(corners)
+        sizes = DetectionStore.sizes(corners)
+        if self.spill is not None and not self.args.best:
+            rec = np.zeros(ids.size, self.SPILL_DTYPE)
+            rec['x'] = centers[:, 0]
+            rec['y'] = centers[:, 1]
+            rec['image'] = self.store.intern(image_name)
+            rec['id'] = ids
+            rec['dict'] = dict_ids
+            rec['size'] = sizes
+            self.spill.write(rec.tobytes())
+            return
+        name = os.path.basename(image_name)
         for i in range(ids.size):
-            j = ids[i][0]
-            if j not in self.gcp_found:
-                self.gcp_found[j] = []
-            self.gcp_found[j].append(image_name)
-            # calculate center of aruco code
-            x = int(round(np.average(corners[i][0][:, 0])))
-            y = int(round(np.average(corners[i][0][:, 1])))
-            self.gcps.append((x, y, os.path.basename(image_name), j, corners[i][0]))
-            if self.args.debug:
-                if j in self.coords:
-                    plt.plot(x, y, args.markerstyle, markersize=self.args.markersize,
-                                                     markeredgecolor=args.edgecolor, markeredgewidth=args.edgewidth)
+            gcp = (centers[i, 0], centers[i, 1], name, ids[i], sizes[i], dict_ids[i])
+            self.seq += 1
+            if self.args.best:
+                # bounded heap, the worst observation is on top
+                heap = self.best.setdefault(gcp[3], [])
+                item = (scores[i] if scores else 0.0, -self.seq, gcp)
+                if len(heap) < self.args.best:
+                    heapq.heappush(heap, item)
                 else:
-                    plt.plot(x, y, args.markerstyle1, markersize=self.args.markersize,
-                             markeredgecolor=args.edgecolor, markeredgewidth=args.edgewidth)
-                plt.text(x+self.args.markersize, y, str(ids[i][0]),
-                         color=args.fontcolor1, weight=args.fontweight1, fontsize=args.fontsize)
-                plt.text(x+self.args.markersize, y, str(ids[i][0]),
-                         color=args.fontcolor, weight=args.fontweight, fontsize=args.fontsize)
-        if args.debug:
-            #plt.legend()
-            plt.show()
+                    heapq.heappushpop(heap, item)
+            else:
+                self.write_gcp(self.foutput, gcp)
+        if not self.args.best:
+            # rows of the image are usable immediately
+            self.foutput.flush()
 
-    def gcp_output(self):
-        """ output GPCs to output file """
+    def replay_spill(self, chunk=65536):
+        """ read observations back from the spill file
+
+            :param chunk: number of records read at once
+            :return: generator of (x, y, image name, id, size, dictionary id) tuples
+        """
+        basenames = [os.path.basename(name) for name in self.store.names]
+        self.spill.seek(0)
+        while True:
+            buf = self.spill.read(chunk * self.SPILL_DTYPE.itemsize)
+            if not buf:
+                break
+            for rec in np.frombuffer(buf, self.SPILL_DTYPE):
+                yield (rec['x'], rec['y'], basenames[rec['image']],
+                       rec['id'], rec['size'], rec['dict'])
+
+    def open_output(self):
+        """ open output file and write header
+
+            :return: file object or None in case of error
+        """
         if self.args.output == sys.stdout:
             foutput = self.args.output
+        elif self.journal is not None and not self.args.stream:
+            # output is written to a temporary file and renamed at the end
+            try:
+                fd, self.output_tmp = tempfile.mkstemp(
+                    dir=os.path.dirname(os.path.abspath(self.args.output)),
+                    prefix=os.path.basename(self.args.output) + '.', suffix='.tmp')
+                foutput = os.fdopen(fd, 'w', encoding="ascii")
+            except Exception:
+                print('cannot open output file', file=sys.stderr)
+                return None
         else:
             try:
                 foutput = open(self.args.output, 'w', encoding="ascii")
             except Exception:
                 print('cannot open output file', file=sys.stderr)
-                return
+                return None
+        self.write_header(foutput)
+        return foutput
+
+    def write_header(self, foutput):
+        """ write header of output
+
+            :param foutput: output file object
+        """
         if self.args.type == 'ODM' and self.args.epsg is not None:
             # write epsg code to the beginning of the output
             foutput.write(f'EPSG:{self.args.epsg}\n')
 
-        for gcp in self.gcps:
-            j = gcp[3]
-            if self.args.type == 'ODM':
-                if j in self.coords:
-                    if len(self.gcp_found[j]) <= self.args.limit:
-                        foutput.write(f"{self.coords[j][0]} {self.coords[j][1]} {self.coords[j][2]} {gcp[0]} {gcp[1]} {gcp[2]} {j}\n")
-                        # .format( self.coords[j][0], self.coords[j][1], self.coords[j][2], gcp[0], gcp[1], gcp[2], j))
-                    else:
-                        print(f"GCP {j} over limit it is dropped on image {gcp[2]}", file=sys.stderr)
-                else:
-                    print(f"No coordinates for {j}", file=sys.stderr)
-            elif self.args.type == 'VisualSfM':
-                if j in self.coords:
-                    if len(self.gcp_found[j]) <= self.args.limit:
-                        foutput.write(f"{gcp[2]} {gcp[0]} {gcp[1]} {self.coords[j][0]} {self.coords[j][1]} {self.coords[j][2]} {j}\n")
-                        #.format( gcp[2], gcp[0], gcp[1], self.coords[j][0], self.coords[j][1], self.coords[j][2], j))
-                    else:
-                        print(f"GCP {j} over limit it is dropped on image {gcp[2]}", file=sys.stderr)
-                else:
-                    print(f"No coordinates for {j}", file=sys.stderr)
-            elif self.args.type == 'Meshroom':
-                if j in self.coords:
-                    if len(self.gcp_found[j]) <= self.args.limit:
-                        corners = gcp[4]
-                        tl = corners[2]
-                        bl = corners[1]
-                        br = corners[0]
-                        tr = corners[3]
-
-                        max_sides = max(norm(tl-bl), norm(bl-br), norm(br-tr), norm(tr-tl))
-                        max_diagonal = max(0.707*norm(tl-br), 0.707*norm(tr-bl))
-
-                        size = 0.5 * max(max_sides, max_diagonal)
-
-                        foutput.write(f"{gcp[0]} {gcp[1]} {gcp[2]} {j} {size:.4f}\n")
-                        #.format( gcp[0], gcp[1], gcp[2], j, size))
-                    else:
-                        print(f"GCP {j} over limit it is dropped on image {gcp[2]}", file=sys.stderr)
-                else:
-                    print(f"No coordinates for {j}", file=sys.stderr)
-            else:
-                if j in self.coords:
-                    if len(self.gcp_found[j]) <= self.args.limit:
-                        foutput.write(f"{self.coords[j][0]} {self.coords[j][1]} {self.coords[j][2]} {gcp[0]} {gcp[1]} {gcp[2]} {j}\n")
-                        # .format( self.coords[j][0], self.coords[j][1], self.coords[j][2], gcp[0], gcp[1], gcp[2], j))
-                    else:
-                        print(f"GCP {j} over limit it is dropped on image {gcp[2]}", file=sys.stderr)
-                else:
-                    if len(self.gcp_found[j]) <= self.args.limit:
-                        foutput.write(f"{gcp[0]} {gcp[1]} {gcp[2]} {j}\n")
-                        # .format( gcp[0], gcp[1], gcp[2], j))
-                    else:
-                        print(f"GCP {j} over limit it is dropped on image {gcp[2]}", file=sys.stderr)
+    def gcp_line(self, gcp):
+        """ format output line of a GCP observation
+
+            :param gcp: tuple of x, y, image name, id, marker size and dictionary id
+            :return: output line or None if coordinates of GCP are necessary but unknown
+        """
+        j = gcp[3]
+        # source dictionary is added in case of several dictionaries,
+        # only to formats accepting extra columns (ODM and plain)
+        tag = f" {gcp[5]}" if len(self.args.dict) > 1 else ""
+        if j not in self.coords:
+            if self.args.type is None:
+                return f"{gcp[0]} {gcp[1]} {gcp[2]} {j}{tag}\n"
+            return None
+        if self.args.type == 'VisualSfM':
+            return f"{gcp[2]} {gcp[0]} {gcp[1]} {self.coords[j][0]} {self.coords[j][1]} {self.coords[j][2]} {j}\n"
+        if self.args.type == 'Meshroom':
+            return f"{gcp[0]} {gcp[1]} {gcp[2]} {j} {gcp[4]:.4f}\n"
+        # ODM and plain output with coordinates
+        return f"{self.coords[j][0]} {self.coords[j][1]} {self.coords[j][2]} {gcp[0]} {gcp[1]} {gcp[2]} {j}{tag}\n"
+
+    def write_gcp(self, foutput, gcp, counts=None, ferr=None):
+        """ write a GCP observation to output if it is not over the limit
+
+            :param foutput: output file object
+            :param gcp: tuple of x, y, image name, id, marker size and dictionary id
+            :param counts: number of observations by marker id, necessary for limit
+            :param ferr: file object for messages, default stderr
+        """
+        if ferr is None:
+            ferr = sys.stderr
+        j = gcp[3]
+        line = self.gcp_line(gcp)
+        if line is None:
+            print(f"No coordinates for {j}", file=ferr)
+        elif self.args.limit is None or counts[j] <= self.args.limit:
+            foutput.write(line)
+        else:
+            print(f"GCP {j} over limit it is dropped on image {gcp[2]}", file=ferr)
+
+    def gcp_output(self):
+        """ output GPCs to output file, in stream mode only the
+            observations of the spill file are written, in best mode the
+            best observations are written in the order of processing
+        """
+        if self.foutput is None:
+            foutput = self.open_output()
+            if foutput is None:
+                return
+            gcps = self.store.rows()
+        else:
+            foutput = self.foutput
+            gcps = self.replay_spill() if self.spill is not None else []
+        if self.args.best:
+            items = sorted((item for heap in self.best.values() for item in heap),
+                           key=lambda item: -item[1])
+            gcps = [item[2] for item in items]
+            if self.args.verbose:
+                print(f'{len(gcps)} best observations kept of {self.seq}', file=sys.stderr)
+        counts = None
+        if self.args.limit is not None:
+            counts = self.id_counts if self.args.stream else self.store.counts()
+        for gcp in gcps:
+            self.write_gcp(foutput, gcp, counts)
+        if self.spill is not None:
+            self.spill.close()
         if self.args.output != sys.stdout:
             foutput.close()
+        if self.output_tmp is not None:
+            os.replace(self.output_tmp, self.args.output)
 
 def cmd_params(parser, params):
     """ set up command line argument parser
@@ -321,13 +3110,31 @@ def cmd_params(parser, params):
     def_fontcolor1 = 'y'            # outer color for GP ID annotation
     def_fontweight = 'normal'       # weight for inner text
     def_fontweight1 = 'bold'        # weight for outet text
-    def_limit = 999                 # limit for individual id records in output
+    def_limit = None                # limit for individual id records in output
+    def_jobs = cpu_count()          # number of parallel processes
+    def_prefetch = 2                # number of images read ahead
+    def_readers = 1                 # number of image reader threads
+    def_maxmpix = 200               # megapixels read ahead
+    def_cache = '.gcp_find_cache.sqlite'    # detection cache file
+    def_cachesize = 100             # max size of detection cache in MB
+    def_scale = 1                   # image reduction for detection
+    def_expect = 1                  # expected number of markers on reduced image
+    def_decode = 'color'            # decode strategy
+    def_tile = 0                    # tile size for large images
+    def_maxmarker = 200             # max marker size in pixels (tile overlap)
+    def_tilethreads = 1             # threads to process tiles
+    def_sensordb = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'gsd_calc', 'sensordb.json')   # camera database
+    def_margin = 10                 # safety margin around image footprint
+    def_roisigma = 5                # position uncertainty for roi windows
+    def_batch = 8                   # images claimed by a worker at once
+    def_lease = 300.0               # lease time of claimed images in seconds
 
     parser.add_argument('names', metavar='file_names', type=str, nargs='*',
                         help='image files to process')
     # general parameters
-    parser.add_argument('-d', '--dict', type=int, default=def_dict,
-                        help=f'marker dictionary id, default={def_dict} (DICT_4X4_100)')
+    parser.add_argument('-d', '--dict', type=dict_list, default=[def_dict],
+                        help=f'marker dictionary id or comma separated ids of several dictionaries, default={def_dict} (DICT_4X4_100)')
     parser.add_argument('-o', '--output', type=str, default=def_output,
                         help='name of output GCP list file, default stdout')
     parser.add_argument('-t', '--type', choices=['ODM', 'VisualSfM', 'Meshroom'],
@@ -348,6 +3155,91 @@ def cmd_params(parser, params):
                         help='epsg code for gcp coordinates, default None')
     parser.add_argument('-a', '--adjust', action="store_true",
                         help='adjust colors by built in lookup table')
+    parser.add_argument('-j', '--jobs', type=int, default=def_jobs,
+                        help='number of parallel worker processes, default: number of usable CPUs')
+    parser.add_argument('--prefetch', type=int, default=def_prefetch,
+                        help=f'number of images read ahead in background if a single process is used, 0 to switch off, default: {def_prefetch}')
+    parser.add_argument('--readers', type=int, default=def_readers,
+                        help=f'number of image reader threads for prefetch, default: {def_readers}')
+    parser.add_argument('--maxmpix', type=float, default=def_maxmpix,
+                        help=f'max megapixels of images read ahead, 0 for no limit, default: {def_maxmpix}')
+    parser.add_argument('--cache', type=str, default=def_cache,
+                        help=f'SQLite file to cache markers found on images, default: {def_cache}')
+    parser.add_argument('--no-cache', action="store_true",
+                        help='do not use detection cache')
+    parser.add_argument('--cachesize', type=float, default=def_cachesize,
+                        help=f'max size of detection cache in MB, default: {def_cachesize}')
+    parser.add_argument('--cachehash', action="store_true",
+                        help='identify images in cache by content hash instead of path and modification time')
+    parser.add_argument('--scale', type=int, choices=[1, 2, 4, 8], default=def_scale,
+                        help=f'search markers on an image reduced by scale and refine corners on the original image, default: {def_scale}')
+    parser.add_argument('--expect', type=int, default=def_expect,
+                        help=f'search markers on the original image if less markers found on the reduced image, markers of GCPs predicted on the image are also expected, use together with scale, default: {def_expect}')
+    parser.add_argument('--decode', choices=['color', 'gray', 'reduced'],
+                        default=def_decode,
+                        help=f'image decode strategy, color: decode color image and convert to gray, gray: decode gray image (faster, markers may be slightly different), reduced: decode reduced gray image for scale, default: {def_decode}')
+    parser.add_argument('--tile', type=int, default=def_tile,
+                        help=f'process large images in overlapping tiles of this size in pixels, 0 for no tiles, default: {def_tile}')
+    parser.add_argument('--maxmarker', type=int, default=def_maxmarker,
+                        help=f'max marker size in pixels, overlap of tiles, use together with tile, default: {def_maxmarker}')
+    parser.add_argument('--tilethreads', type=int, default=def_tilethreads,
+                        help=f'number of threads to process tiles, use together with tile, default: {def_tilethreads}')
+    parser.add_argument('--prefilter', action="store_true",
+                        help='skip images whose ground footprint contains no GCP, EXIF position of images, input coordinates and epsg are necessary')
+    parser.add_argument('--camera', type=str, default=None,
+                        help='camera name from sensor database (see gsd_calc), default: None')
+    parser.add_argument('--sensordb', type=str, default=def_sensordb,
+                        help='sensor database file, default: gsd_calc/sensordb.json')
+    parser.add_argument('--swidth', type=float, default=None,
+                        help='sensor width in mm, overrides value from sensor database, default: None')
+    parser.add_argument('--focal', type=float, default=None,
+                        help='focal length in mm, overrides value from EXIF, default: None')
+    parser.add_argument('--height', type=float, default=None,
+                        help='flight height above ground in meters, default: EXIF altitude minus GCP elevation')
+    parser.add_argument('--margin', type=float, default=def_margin,
+                        help=f'safety margin around image footprint in meters, default: {def_margin}')
+    parser.add_argument('--roi', action="store_true",
+                        help='search markers in windows around GCP positions predicted from EXIF position and yaw, same parameters are necessary as for prefilter')
+    parser.add_argument('--roisigma', type=float, default=def_roisigma,
+                        help=f'uncertainty of predicted GCP positions in meters, half window size, use together with roi, default: {def_roisigma}')
+    parser.add_argument('--markercm', type=float, default=None,
+                        help='marker size in cm, marker size and threshold window parameters are set from the GSD of images, default: None')
+    parser.add_argument('--gsd', type=float, default=None,
+                        help='ground sample distance in cm/pixel for markercm, default: calculated from EXIF altitude and camera parameters')
+    parser.add_argument('--escalate', type=str, default=None,
+                        help='JSON file of a list of ArUco parameter sets (aruco_params format, adjust can also be given) for further detection passes if the result of previous pass is incomplete, default: None')
+    parser.add_argument('--imagelog', type=str, default=None,
+                        help='write detection info of images (markers found, escalation pass) to a JSON lines file, default: None')
+    parser.add_argument('--deadline-ms', type=float, default=None,
+                        help='time budget of an image in milliseconds, markers are searched on a reduced image first and finer quality levels are run while the budget allows, default: None')
+    parser.add_argument('--subdict', action="store_true",
+                        help='use a reduced dictionary of markers in input coordinate file or ids, default: False')
+    parser.add_argument('--ids', type=str, default=None,
+                        help='comma separated list of marker ids and ranges (e.g. 1-12,20) for the reduced dictionary, default: None')
+    parser.add_argument('--best', type=int, default=None,
+                        help='keep the best N observations of GCPs by marker size, distance from image center, corner angles and sharpness, default: None')
+    parser.add_argument('--stream', action="store_true",
+                        help='write output rows as images are processed, with limit rows are written at the end from a temporary file, default: False')
+    parser.add_argument('--journal', type=str, default=None,
+                        help='journal file of markers found on images, an interrupted run is continued from it, default: None')
+    parser.add_argument('--shard', type=shard_spec, default=None,
+                        help='process the K-th of N parts of images (K/N) balanced by file size, the raw markers are written to the output file to merge, default: None')
+    parser.add_argument('--merge', action="store_true",
+                        help='file names are partial results of shards to merge, output is the same as of a single run, default: False')
+    parser.add_argument('--queue', type=str, default=None,
+                        help='SQLite work queue on a shared file system for worker and collect, default: None')
+    parser.add_argument('--worker', action="store_true",
+                        help='add images to the queue and process images of the queue, any number of workers can run on any host, default: False')
+    parser.add_argument('--collect', action="store_true",
+                        help='write output from the results of the queue, default: False')
+    parser.add_argument('--batch', type=int, default=def_batch,
+                        help=f'number of images claimed at once by a worker, default: {def_batch}')
+    parser.add_argument('--lease', type=float, default=def_lease,
+                        help=f'seconds after the images of a dead worker are claimed again, default: {def_lease}')
+    parser.add_argument('--serve', type=server_address, default=None,
+                        help='answer detection requests of clients (see gcp_client.py) on a Unix domain socket (path) or TCP port (host:port), default: None')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='write wall and CPU time of processing stages and size of image buffers to a JSON file, default: None')
     # parameters for marker display
     parser.add_argument('--markersize', type=int, default=def_markersize,
                         help='marker size on debug image, use together with debug, default: {def_markersize}')
@@ -429,7 +3321,9 @@ def cmd_params(parser, params):
                         help=f'min marker perimeter rate, default {params.minMarkerPerimeterRate}')
     parser.add_argument('--otsu', type=float, default=params.minOtsuStdDev,
                         help=f'minimum stddev of pixel values, default {params.minOtsuStdDev}')
-    # TODO minSideLengthCanonicalImg missing
+    parser.add_argument('--minside', type=int,
+                        default=params.minSideLengthCanonicalImg,
+                        help=f'min side length of markers on the downsampled image of ArUco3 detection, default {params.minSideLengthCanonicalImg}')
     parser.add_argument('--ignore', type=float,
                         default=params.perspectiveRemoveIgnoredMarginPerCell,
                         help=f'Ignored pixels at cell borders, default {params.perspectiveRemoveIgnoredMarginPerCell}')
@@ -441,6 +3335,8 @@ def cmd_params(parser, params):
                         help=f'polygonal approx accuracy rate, default {params.polygonalApproxAccuracyRate}')
     parser.add_argument('--aruco3', action="store_true",
                         help=f'use ArUco3 detection, default {params.useAruco3Detection}')
+    parser.add_argument('--fast', action="store_true",
+                        help='use ArUco3 detection, lengthratio is derived from the expected marker size (minrate or markercm) and minside if not given')
 
 if __name__ == "__main__":
     T1 = time.perf_counter()
@@ -457,6 +3353,9 @@ if __name__ == "__main__":
             names += glob.glob(name)
         args.names = names
     gcps = GcpFind(args, params)
-    gcps.process_images()
+    if args.serve:
+        gcps.serve()
+    else:
+        gcps.process_images()
     T2 = time.perf_counter()
     print(f'Finished in {T2-T1} seconds', file=sys.stderr)
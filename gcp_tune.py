@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+    Tune ArUco detection parameters of gcp_find.py on labelled images,
+    the labels are taken from a previous output of gcp_find.py or from
+    synthetic images, all gcp_find.py parameters can be used
+"""
+import os
+import sys
+import copy
+import math
+import time
+import json
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+import cv2
+from cv2 import aruco
+from gcp_find import GcpFind, MarkerDetector, cmd_params, cpu_count, \
+                     params_to_dict, dict_to_params
+from gcp_bench import synthetic_params, make_images, match
+
+def_trials = 32         # number of random parameter sets
+def_eta = 2             # reduction factor of successive halving
+def_survivors = 8       # number of parameter sets evaluated on all images
+def_tolerance = 3.0     # max center distance of the same marker in pixels
+
+# parameter space to search in
+SPACE = {'adaptiveThreshWinSizeMin': [3, 5, 7, 11, 15],
+         'adaptiveThreshWinSizeMax': [15, 23, 31, 41, 53],
+         'adaptiveThreshWinSizeStep': [4, 6, 10, 16, 24],
+         'adaptiveThreshConstant': [3.0, 5.0, 7.0, 9.0, 11.0],
+         'minMarkerPerimeterRate': [0.005, 0.01, 0.02, 0.03, 0.05],
+         'polygonalApproxAccuracyRate': [0.02, 0.03, 0.05, 0.08],
+         'cornerRefinementMethod': [0, 1, 2],
+         'perspectiveRemoveIgnoredMarginPerCell': [0.1, 0.13, 0.2, 0.33],
+         'perspectiveRemovePixelPerCell': [2, 4, 8],
+         'errorCorrectionRate': [0.4, 0.6, 0.8],
+         'minOtsuStdDev': [2.0, 5.0, 10.0]}
+
+def read_truth(path, img_path):
+    """ read markers from an output file of gcp_find.py (any output type)
+
+        :param path: path to output file of gcp_find.py
+        :param img_path: directory of images
+        :return: dictionary of image path and list of (id, x, y, None) tuples
+    """
+    truth = {}
+    with open(path, encoding='ascii') as f:
+        for line in f:
+            items = line.split()
+            if not items or items[0].startswith('EPSG:'):
+                continue
+            if len(items) == 4:             # x y image id
+                x, y, name, j = items
+            elif len(items) == 5:           # Meshroom: x y image id size
+                x, y, name, j = items[:4]   # or x y image id dict
+            elif len(items) == 7:
+                try:                        # ODM: e n h x y image id
+                    float(items[5])
+                    name, x, y, j = items[0], items[1], items[2], items[6]
+                except ValueError:
+                    x, y, name, j = items[3], items[4], items[5], items[6]
+            elif len(items) == 8:           # ODM: e n h x y image id dict
+                x, y, name, j = items[3], items[4], items[5], items[6]
+            else:
+                continue
+            name = os.path.join(img_path, name)
+            truth.setdefault(name, []).append((int(j), float(x), float(y), None))
+    return truth
+
+_tune_args = None
+_tune_truth = None
+_tune_camera = None
+_tune_images = {}
+
+def init_worker(args, truth, camera, threads):
+    """ initialize a worker process of the tuner
+
+        :param args: processed command line parameters
+        :param truth: dictionary of image path and list of markers
+        :param camera: camera model or None
+        :param threads: number of OpenCV threads in the worker
+    """
+    global _tune_args, _tune_truth, _tune_camera
+    cv2.setNumThreads(threads)
+    _tune_args = args
+    _tune_truth = truth
+    _tune_camera = camera
+
+def evaluate(task):
+    """ detect markers by a parameter set on images in a worker process
+
+        :param task: tuple of index and parameter dictionary and list of image paths
+        :return: tuple of index, detection time, found, all and false markers
+    """
+    index, par_dict, names = task
+    detector = MarkerDetector(_tune_args, dict_to_params(par_dict), camera=_tune_camera)
+    elapsed = 0.0
+    n_found = n_all = n_false = 0
+    for name in names:
+        if name not in _tune_images:
+            # images are decoded only once in a worker
+            frame = detector.read_image(name)
+            _tune_images[name] = None if frame is None else detector.gray_image(frame)
+        gray = _tune_images[name]
+        n_all += len(_tune_truth[name])
+        if gray is None:
+            continue
+        t1 = time.perf_counter()
+        ids, corners, _ = detector.detect(gray, name)
+        elapsed += time.perf_counter() - t1
+        truth = _tune_truth[name]
+        ref_ids = np.array([t[0] for t in truth], np.int32)
+        ref_centers = np.array([t[1:3] for t in truth], np.float32).reshape(-1, 2)
+        tols = [_tune_args.tolerance if t[3] is None else t[3] / 2 for t in truth]
+        found, _ = match(ids, corners, ref_ids, ref_centers, tols)
+        n_found += found
+        n_false += len(ids) - found
+    return index, elapsed, n_found, n_all, n_false
+
+def candidates(base, space, trials, rng):
+    """ generate random parameter sets
+
+        :param base: dictionary of base parameters
+        :param space: dictionary of parameter names and possible values
+        :param trials: number of parameter sets
+        :param rng: random generator
+        :return: list of parameter dictionaries, the first is the base
+    """
+    result = [base]
+    for _ in range(trials):
+        par_dict = dict(base)
+        for par, values in space.items():
+            par_dict[par] = values[rng.integers(len(values))]
+        if par_dict['adaptiveThreshWinSizeMax'] < par_dict['adaptiveThreshWinSizeMin']:
+            par_dict['adaptiveThreshWinSizeMax'] = par_dict['adaptiveThreshWinSizeMin']
+        result.append(par_dict)
+    return result
+
+def dominates(score1, score2):
+    """ check if a (time, recall, false markers) score dominates an other
+
+        :param score1: first score
+        :param score2: second score
+        :return: True if score1 is not worse in any and better in some objective
+    """
+    return score1[0] <= score2[0] and score1[1] >= score2[1] and \
+           score1[2] <= score2[2] and score1 != score2
+
+def pareto_rank(scores):
+    """ non dominated sorting of (time, recall, false markers) scores
+
+        :param scores: list of (time, recall, false markers) tuples
+        :return: list of ranks, 0 for the Pareto front
+    """
+    ranks = [None] * len(scores)
+    rest = set(range(len(scores)))
+    rank = 0
+    while rest:
+        front = [i for i in rest
+                 if not any(dominates(scores[k], scores[i]) for k in rest)]
+        for i in front:
+            ranks[i] = rank
+        rest -= set(front)
+        rank += 1
+    return ranks
+
+def tune(args, base, truth, camera=None):
+    """ search parameter space by successive halving
+
+        :param args: processed command line parameters
+        :param base: dictionary of base parameters
+        :param truth: dictionary of image path and list of markers
+        :param camera: camera model or None
+        :return: list of (parameters, time per image, recall, false markers) for the Pareto front ordered by time
+    """
+    rng = np.random.default_rng(args.seed)
+    space = SPACE
+    if args.space:
+        with open(args.space, encoding='ascii') as f:
+            space = json.load(f)
+    configs = candidates(base, space, args.trials, rng)
+    names = list(truth)
+    rng.shuffle(names)
+    rounds = max(0, math.ceil(math.log(max(1, len(configs) / args.survivors), args.eta)))
+    jobs = max(1, min(args.jobs, len(configs)))
+    worker_args = argparse.Namespace(**vars(args))
+    worker_args.output = None
+    threads = max(1, cpu_count() // jobs)
+    with multiprocessing.Pool(jobs, init_worker, (worker_args, truth, camera, threads)) as pool:
+        for r in range(rounds + 1):
+            n = min(len(names), max(1, math.ceil(len(names) / args.eta ** (rounds - r))))
+            tasks = [(i, par_dict, names[:n]) for i, par_dict in enumerate(configs)]
+            results = sorted(pool.imap_unordered(evaluate, tasks))
+            scores = [(res[1] / n, res[2] / res[3] if res[3] else 1.0, res[4])
+                      for res in results]
+            print(f'round {r + 1}: {len(configs)} parameter sets on {n} images', file=sys.stderr)
+            if r < rounds:
+                ranks = pareto_rank(scores)
+                # the base parameter set is always kept as reference
+                order = sorted(range(1, len(configs)),
+                               key=lambda i: (ranks[i], -scores[i][1], scores[i][2], scores[i][0]))
+                keep = max(args.survivors, math.ceil(len(configs) / args.eta))
+                configs = [configs[0]] + [configs[i] for i in order[:keep-1]]
+    ranks = pareto_rank(scores)
+    front = [(configs[i],) + scores[i] for i in range(len(configs)) if ranks[i] == 0]
+    return sorted(front, key=lambda f: f[1])
+
+def choose(front, min_recall, max_false):
+    """ choose a point of the Pareto front
+
+        :param front: list of (parameters, time, recall, false markers), ordered by time
+        :param min_recall: minimal recall or None for max recall
+        :param max_false: max number of false markers
+        :return: chosen item of front
+    """
+    usable = [item for item in front if item[3] <= max_false]
+    if not usable:
+        usable = front
+    if min_recall is not None:
+        for item in usable:
+            if item[2] >= min_recall:
+                return item
+    return max(usable, key=lambda f: (f[2], -f[3], -f[1]))
+
+def get_truth(args, tmp):
+    """ get labelled images from output file or synthetic images
+
+        :param args: processed command line parameters
+        :param tmp: temporary directory for synthetic images
+        :return: dictionary of image path and list of markers
+    """
+    if args.synthetic > 0:
+        path = args.keep if args.keep else tmp
+        os.makedirs(path, exist_ok=True)
+        names, truths = make_images(args, path)
+        return dict(zip(names, truths))
+    truth = read_truth(args.truth, args.path)
+    if args.names:
+        # use only given images
+        names = set(os.path.normpath(name) for name in args.names)
+        truth = {name: val for name, val in truth.items()
+                 if os.path.normpath(name) in names}
+    for name in [name for name in truth if not os.path.isfile(name)]:
+        print(f'image not found {name}', file=sys.stderr)
+        del truth[name]
+    return truth
+
+if __name__ == "__main__":
+    params = aruco.DetectorParameters()
+    parser = argparse.ArgumentParser(description='tune ArUco parameters on labelled images, the Pareto front of detection time and recall is listed and the chosen parameters are written to the output in aruco_params format')
+    cmd_params(parser, params)
+    parser.add_argument('--truth', type=str, default=None,
+                        help='output of gcp_find.py as ground truth, default None')
+    parser.add_argument('--path', type=str, default='',
+                        help='directory of images in truth file, default current directory')
+    parser.add_argument('--trials', type=int, default=def_trials,
+                        help=f'number of random parameter sets, default {def_trials}')
+    parser.add_argument('--eta', type=int, default=def_eta,
+                        help=f'reduction factor of successive halving, default {def_eta}')
+    parser.add_argument('--survivors', type=int, default=def_survivors,
+                        help=f'number of parameter sets evaluated on all images, default {def_survivors}')
+    parser.add_argument('--space', type=str, default=None,
+                        help='JSON file of parameter names and lists of values to search, default built in space')
+    parser.add_argument('--minrecall', type=float, default=None,
+                        help='choose the fastest parameter set with at least this recall, default the best recall')
+    parser.add_argument('--maxfalse', type=int, default=0,
+                        help='max number of false markers of the chosen parameter set, default 0')
+    parser.add_argument('--tolerance', type=float, default=def_tolerance,
+                        help=f'max center distance of the same marker in pixels, default {def_tolerance}')
+    synthetic_params(parser)
+    args = parser.parse_args()
+    if args.truth is None and args.synthetic == 0:
+        print('truth file or synthetic images are necessary', file=sys.stderr)
+        sys.exit(1)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        truth = get_truth(args, tmp_dir)
+        if not truth:
+            print('no labelled images found', file=sys.stderr)
+            sys.exit(1)
+        # base parameters from command line or aruco_params file
+        base_args = copy.copy(args)
+        base_args.names = list(truth)
+        base_args.no_cache = True
+        base_args.list = False
+        base_find = GcpFind(base_args, params)
+        base = params_to_dict(base_find.params)
+        front = tune(args, base, truth, base_find.camera)
+    best = choose(front, args.minrecall, args.maxfalse)
+    print(f'{"ms/image":>9s} {"recall":>6s} {"false":>5s}  changed parameters', file=sys.stderr)
+    for par_dict, elapsed, recall, n_false in front:
+        changed = ' '.join(f'{par}={val}' for par, val in par_dict.items()
+                           if base.get(par) != val)
+        mark = '*' if par_dict is best[0] else ' '
+        print(f'{elapsed*1000:9.1f} {recall:6.3f} {n_false:5d} {mark}{changed}', file=sys.stderr)
+    if args.output == sys.stdout:
+        json.dump(best[0], sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w', encoding='ascii') as f:
+            json.dump(best[0], f, indent=2)